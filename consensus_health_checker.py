@@ -8,15 +8,17 @@ Performs a variety of checks against the present votes and consensus.
 
 import collections
 import datetime
+import multiprocessing
 import os
 import time
 import traceback
 
+from multiprocessing.pool import ThreadPool
+
 import util
 
 import stem.descriptor
 import stem.descriptor.remote
-import stem.directory
 import stem.util.conf
 import stem.util.enum
 
@@ -25,7 +27,7 @@ from stem.util.lru_cache import lru_cache
 
 Runlevel = stem.util.enum.UppercaseEnum('NOTICE', 'WARNING', 'ERROR')
 
-DIRECTORY_AUTHORITIES = stem.directory.Authority.from_cache()
+DIRECTORY_AUTHORITIES = util.get_authorities()
 
 DIRAUTH_SKIP_CHECKS = (
   'tor26',   # tor26 DirPort does not service requests without a .z suffix
@@ -34,6 +36,7 @@ DIRAUTH_SKIP_CHECKS = (
 
 EMAIL_SUBJECT = 'Consensus issues'
 BANDWIDTH_AUTHORITIES = ('moria1', 'gabelmoo', 'maatuska', 'Faravahar', 'bastet', 'longclaw')
+CHECKER_TIMEOUT = 180  # seconds we'll wait on our checks before reporting them as hung
 
 CONFIG = stem.util.conf.config_dict('consensus_health', {
   'msg': {},
@@ -55,6 +58,38 @@ downloader = stem.descriptor.remote.DescriptorDownloader(
 Destination = collections.namedtuple('Destination', ('address', 'bcc'))
 
 
+class VoteSummary(object):
+  """
+  Statistics about a vote's router status entries. Several of our checks need
+  these, so we gather them in a single pass rather than have each walk the
+  thousands of entries in every vote.
+
+  :var set fingerprints: fingerprints of the relays in the vote
+  :var dict flag_counts: mapping of flags to the number of relays with it
+  :var dict measured: mapping of fingerprints to their measured bandwidth,
+    for relays that have a measurement
+  :var set bad_exits: fingerprints of relays with the BadExit flag
+  """
+
+  def __init__(self, vote):
+    self.fingerprints = set()
+    self.flag_counts = {}
+    self.measured = {}
+    self.bad_exits = set()
+
+    for fingerprint, desc in vote.routers.items():
+      self.fingerprints.add(fingerprint)
+
+      for flag in desc.flags:
+        self.flag_counts[flag] = self.flag_counts.get(flag, 0) + 1
+
+      if desc.measured is not None:
+        self.measured[fingerprint] = desc.measured
+
+      if Flag.BADEXIT in desc.flags:
+        self.bad_exits.add(fingerprint)
+
+
 class Issue(object):
   """
   Problem to be reported at the end of the run.
@@ -308,17 +343,31 @@ def main():
   log.debug("Checks finished, runtime was %0.2f seconds" % (time.time() - start_time))
 
 
-def run_checks(consensuses, votes):
+def run_checks(consensuses, votes, checker_functions = None, timings = None):
   """
-  Performs our checks against the given consensus and vote documents. Checker
+  Performs our checks against the given consensus and vote documents. Checks
+  run concurrently, and any that haven't finished within CHECKER_TIMEOUT
+  seconds are reported as an issue rather than holding up our report. Checker
   functions are expected to be of the form...
 
-    my_check(latest_consensus, consensuses, votes) => Issue or list of Issues
+    my_check(latest_consensus, consensuses, votes, summaries) => Issue or list of Issues
+
+  ... where summaries is a mapping of authorities to the VoteSummary of their
+  vote.
 
   :param dict consensuses: mapping of authorities to their consensus
   :param dict votes: mapping of authorities to their votes
+  :param list checker_functions: checks to run, CHECKER_FUNCTIONS if **None**
+  :param dict timings: if provided this is populated with the seconds taken
+    to summarize the votes and by each checker
   """
 
+  if checker_functions is None:
+    checker_functions = CHECKER_FUNCTIONS
+
+  if timings is None:
+    timings = {}
+
   latest_consensus, latest_valid_after = None, None
 
   for consensus in consensuses.values():
@@ -326,35 +375,26 @@ def run_checks(consensuses, votes):
       latest_consensus = consensus
       latest_valid_after = consensus.valid_after
 
-  checker_functions = (
-    missing_latest_consensus,
-    missing_authority_descriptor,
-    consensus_method_unsupported,
-    different_recommended_client_version,
-    different_recommended_server_version,
-    #unknown_consensus_parameters,  # tor is fiddling with these quite a bit, #24895
-    #vote_parameters_mismatch_consensus,
-    certificate_expiration,
-    consensuses_have_same_votes,
-    has_all_signatures,
-    voting_bandwidth_scanners,
-    #unmeasured_relays,
-    has_authority_flag,
-    has_similar_flag_counts,
-    is_recommended_versions,
-    bad_exits_in_sync,
-    bandwidth_authorities_in_sync,
-    is_orport_reachable,
-    shared_random_present,
-    shared_random_commit_partitioning,
-    shared_random_reveal_partitioning,
-    old_dizum_address_reachable,
-  )
+  start_time = time.time()
+  summaries = dict((authority, VoteSummary(vote)) for authority, vote in votes.items())
+  timings['summaries'] = time.time() - start_time
 
+  # Checkers each get their own thread so a hung one can't keep the others
+  # from running. Hung threads are daemons, so they won't block our exit.
+
+  pool = ThreadPool(len(checker_functions))
+  pending = [(checker, pool.apply_async(_run_checker, (checker, timings, latest_consensus, consensuses, votes, summaries))) for checker in checker_functions]
+  pool.close()
+
+  deadline = time.time() + CHECKER_TIMEOUT
   all_issues = []
 
-  for checker in checker_functions:
-    issues = checker(latest_consensus, consensuses, votes)
+  for checker, result in pending:
+    try:
+      issues = result.get(max(0, deadline - time.time()))
+    except multiprocessing.TimeoutError:
+      log.warn("%s didn't finish within %i seconds" % (checker.__name__, CHECKER_TIMEOUT))
+      issues = Issue(Runlevel.WARNING, 'CHECKER_TIMED_OUT', checker = checker.__name__, timeout = CHECKER_TIMEOUT)
 
     if issues:
       if isinstance(issues, Issue):
@@ -367,7 +407,24 @@ def run_checks(consensuses, votes):
   return all_issues
 
 
-def missing_latest_consensus(latest_consensus, consensuses, votes):
+def _run_checker(checker, timings, *args):
+  """
+  Runs a checker function, recording its runtime and including its stacktrace
+  in any exception it raises since otherwise that's lost when we're run within
+  a thread pool.
+  """
+
+  start_time = time.time()
+
+  try:
+    return util.profile('consensus_health_checker.%s' % checker.__name__, checker, *args)
+  except:
+    raise RuntimeError("%s failed with:\n\n%s" % (checker.__name__, traceback.format_exc()))
+  finally:
+    timings[checker.__name__] = time.time() - start_time
+
+
+def missing_latest_consensus(latest_consensus, consensuses, votes, summaries):
   "Checks that none of the consensuses are more than an hour old."
 
   stale_authorities = []
@@ -382,7 +439,7 @@ def missing_latest_consensus(latest_consensus, consensuses, votes):
     return Issue(runlevel, 'MISSING_LATEST_CONSENSUS', authorities = ', '.join(stale_authorities), to = stale_authorities)
 
 
-def missing_authority_descriptor(latest_consensus, consensuses, votes):
+def missing_authority_descriptor(latest_consensus, consensuses, votes, summaries):
   """
   Check that each authority has server descriptors for the others. This arises
   when authorities change their Ed25519 key, but others still have the old key
@@ -406,7 +463,7 @@ def missing_authority_descriptor(latest_consensus, consensuses, votes):
   return issues
 
 
-def consensus_method_unsupported(latest_consensus, consensuses, votes):
+def consensus_method_unsupported(latest_consensus, consensuses, votes, summaries):
   "Checks that all of the votes support the present consensus method."
 
   incompatible_authorities = []
@@ -419,7 +476,7 @@ def consensus_method_unsupported(latest_consensus, consensuses, votes):
     return Issue(Runlevel.WARNING, 'CONSENSUS_METHOD_UNSUPPORTED', authorities = ', '.join(incompatible_authorities), to = incompatible_authorities)
 
 
-def different_recommended_client_version(latest_consensus, consensuses, votes):
+def different_recommended_client_version(latest_consensus, consensuses, votes, summaries):
   "Checks that the recommended tor versions for clients match the present consensus."
 
   differences = {}
@@ -432,7 +489,7 @@ def different_recommended_client_version(latest_consensus, consensuses, votes):
     return Issue(Runlevel.NOTICE, 'DIFFERENT_RECOMMENDED_VERSION', type = 'client', differences = ', '.join(differences.values()), to = differences.keys())
 
 
-def different_recommended_server_version(latest_consensus, consensuses, votes):
+def different_recommended_server_version(latest_consensus, consensuses, votes, summaries):
   "Checks that the recommended tor versions for servers match the present consensus."
 
   differences = {}
@@ -467,7 +524,7 @@ def _version_difference_str(authority, consensus_versions, vote_versions):
   return msg
 
 
-def unknown_consensus_parameters(latest_consensus, consensuses, votes):
+def unknown_consensus_parameters(latest_consensus, consensuses, votes, summaries):
   "Checks that votes don't contain any parameters that we don't recognize."
 
   unknown_entries = {}
@@ -486,7 +543,7 @@ def unknown_consensus_parameters(latest_consensus, consensuses, votes):
     return Issue(Runlevel.NOTICE, 'UNKNOWN_CONSENSUS_PARAMETERS', parameters = ', '.join(unknown_entries.values()), to = unknown_entries.keys())
 
 
-def vote_parameters_mismatch_consensus(latest_consensus, consensuses, votes):
+def vote_parameters_mismatch_consensus(latest_consensus, consensuses, votes, summaries):
   "Check that all vote parameters appear in the consensus."
 
   mismatching_entries = {}
@@ -505,7 +562,7 @@ def vote_parameters_mismatch_consensus(latest_consensus, consensuses, votes):
     return Issue(Runlevel.NOTICE, 'MISMATCH_CONSENSUS_PARAMETERS', parameters = ', '.join(mismatching_entries.values()), to = mismatching_entries.keys())
 
 
-def certificate_expiration(latest_consensus, consensuses, votes):
+def certificate_expiration(latest_consensus, consensuses, votes, summaries):
   "Check if an authority's certificate is about to expire."
 
   issues = []
@@ -527,7 +584,7 @@ def certificate_expiration(latest_consensus, consensuses, votes):
   return issues
 
 
-def consensuses_have_same_votes(latest_consensus, consensuses, votes):
+def consensuses_have_same_votes(latest_consensus, consensuses, votes, summaries):
   "Checks that all fresh consensuses are made up of the same votes."
 
   current_time = datetime.datetime.now()
@@ -548,7 +605,7 @@ def consensuses_have_same_votes(latest_consensus, consensuses, votes):
     return Issue(Runlevel.NOTICE, 'MISSING_VOTES', authorities = ', '.join(authorities_missing_votes), to = authorities_missing_votes)
 
 
-def has_all_signatures(latest_consensus, consensuses, votes):
+def has_all_signatures(latest_consensus, consensuses, votes, summaries):
   "Check that the consensuses have signatures for authorities that voted on it."
 
   issues = []
@@ -577,18 +634,13 @@ def has_all_signatures(latest_consensus, consensuses, votes):
   return issues
 
 
-def voting_bandwidth_scanners(latest_consensus, consensuses, votes):
+def voting_bandwidth_scanners(latest_consensus, consensuses, votes, summaries):
   "Checks that we have bandwidth scanner results from the authorities that vote on it."
 
   missing_authorities, extra_authorities = [], []
 
-  for authority, vote in votes.items():
-    contains_measured_bandwidth = False
-
-    for desc in vote.routers.values():
-      if desc.measured:
-        contains_measured_bandwidth = True
-        break
+  for authority, summary in summaries.items():
+    contains_measured_bandwidth = any(summary.measured.values())
 
     if DIRECTORY_AUTHORITIES[authority].nickname in BANDWIDTH_AUTHORITIES and not contains_measured_bandwidth:
       missing_authorities.append(authority)
@@ -607,22 +659,17 @@ def voting_bandwidth_scanners(latest_consensus, consensuses, votes):
   return issues
 
 
-def unmeasured_relays(latest_consensus, consensuses, votes):
+def unmeasured_relays(latest_consensus, consensuses, votes, summaries):
   "Checks that the bandwidth authorities have all formed an opinion about at least 90% of the relays."
 
   issues = []
   consensus_fingerprints = set([desc.fingerprint for desc in latest_consensus.routers.values()])
 
-  for authority, vote in votes.items():
+  for authority, summary in summaries.items():
     if DIRECTORY_AUTHORITIES[authority].nickname in BANDWIDTH_AUTHORITIES:
-      measured, unmeasured = 0, 0
-
-      for desc in vote.routers.values():
-        if desc.fingerprint in consensus_fingerprints:
-          if desc.measured:
-            measured += 1
-          else:
-            unmeasured += 1
+      in_consensus = summary.fingerprints.intersection(consensus_fingerprints)
+      measured = len([fingerprint for fingerprint in in_consensus if summary.measured.get(fingerprint)])
+      unmeasured = len(in_consensus) - measured
 
       total = measured + unmeasured
       percentage = 100 * unmeasured / total
@@ -633,7 +680,7 @@ def unmeasured_relays(latest_consensus, consensuses, votes):
   return issues
 
 
-def has_authority_flag(latest_consensus, consensuses, votes):
+def has_authority_flag(latest_consensus, consensuses, votes, summaries):
   "Checks that the authorities have the 'authority' flag in the present consensus."
 
   seen_authorities = set()
@@ -657,7 +704,7 @@ def has_authority_flag(latest_consensus, consensuses, votes):
   return issues
 
 
-def has_similar_flag_counts(latest_consensus, consensuses, votes):
+def has_similar_flag_counts(latest_consensus, consensuses, votes, summaries):
   "Checks that flags issued by authorities are similar."
 
   issues = []
@@ -667,12 +714,8 @@ def has_similar_flag_counts(latest_consensus, consensuses, votes):
     for flag in desc.flags:
       flag_count[flag] = flag_count.setdefault(flag, 0) + 1
 
-  for authority, vote in votes.items():
-    authority_flag_count = {}
-
-    for desc in vote.routers.values():
-      for flag in desc.flags:
-        authority_flag_count[flag] = authority_flag_count.setdefault(flag, 0) + 1
+  for authority, summary in summaries.items():
+    authority_flag_count = summary.flag_counts
 
     for flag, count in flag_count.items():
       # Skipping check for the following flags because...
@@ -692,7 +735,7 @@ def has_similar_flag_counts(latest_consensus, consensuses, votes):
   return issues
 
 
-def has_expected_fingerprints(latest_consensus, consensuses, votes):
+def has_expected_fingerprints(latest_consensus, consensuses, votes, summaries):
   "Checks that the authorities have the fingerprints that we expect."
 
   issues = []
@@ -707,7 +750,7 @@ def has_expected_fingerprints(latest_consensus, consensuses, votes):
   return issues
 
 
-def is_recommended_versions(latest_consensus, consensuses, votes):
+def is_recommended_versions(latest_consensus, consensuses, votes, summaries):
   "Checks that the authorities are running a recommended version or higher."
 
   outdated_authorities = {}
@@ -724,16 +767,14 @@ def is_recommended_versions(latest_consensus, consensuses, votes):
     return Issue(Runlevel.WARNING, 'TOR_OUT_OF_DATE', authorities = ', '.join(entries), to = outdated_authorities.keys())
 
 
-def bad_exits_in_sync(latest_consensus, consensuses, votes):
+def bad_exits_in_sync(latest_consensus, consensuses, votes, summaries):
   "Checks that the authorities that vote on the BadExit flag are in agreement."
 
   bad_exits = {}  # mapping of authorities to the fingerprints with the BadExit flag
 
-  for authority, vote in votes.items():
-    flagged = [desc.fingerprint for desc in vote.routers.values() if Flag.BADEXIT in desc.flags]
-
-    if flagged:
-      bad_exits[authority] = set(flagged)
+  for authority, summary in summaries.items():
+    if summary.bad_exits:
+      bad_exits[authority] = summary.bad_exits
 
   if not bad_exits:
     return
@@ -750,9 +791,7 @@ def bad_exits_in_sync(latest_consensus, consensuses, votes):
     not_in_vote = []
 
     for authority in voting_authorities.difference(with_flag):
-      vote = votes[authority]
-
-      if fingerprint in vote.routers:
+      if fingerprint in summaries[authority].fingerprints:
         without_flag.append(authority)
       else:
         not_in_vote.append(authority)
@@ -785,7 +824,7 @@ def bad_exits_in_sync(latest_consensus, consensuses, votes):
   return issues
 
 
-def bandwidth_authorities_in_sync(latest_consensus, consensuses, votes):
+def bandwidth_authorities_in_sync(latest_consensus, consensuses, votes, summaries):
   """
   Checks that the bandwidth authorities are reporting roughly the same number
   of measurements. This is in alarm if any of the authorities deviate by more
@@ -794,11 +833,9 @@ def bandwidth_authorities_in_sync(latest_consensus, consensuses, votes):
 
   measurement_counts = {}  # mapping of authorities to the number of fingerprints with a measurement
 
-  for authority, vote in votes.items():
-    measured = [desc.fingerprint for desc in vote.routers.values() if desc.measured is not None]
-
-    if measured:
-      measurement_counts[authority] = len(measured)
+  for authority, summary in summaries.items():
+    if summary.measured:
+      measurement_counts[authority] = len(summary.measured)
 
   if not measurement_counts:
     return
@@ -811,12 +848,12 @@ def bandwidth_authorities_in_sync(latest_consensus, consensuses, votes):
       return Issue(Runlevel.NOTICE, 'BANDWIDTH_AUTHORITIES_OUT_OF_SYNC', authorities = ', '.join(entries), to = measurement_counts.keys())
 
 
-def is_orport_reachable(latest_consensus, consensuses, votes):
+def is_orport_reachable(latest_consensus, consensuses, votes, summaries):
   """
   Simple check to see if we can reach the authority's ORPort.
   """
 
-  issues = []
+  authorities, endpoints = [], []
 
   for authority in DIRECTORY_AUTHORITIES.values():
     desc = latest_consensus.routers.get(authority.fingerprint)
@@ -824,25 +861,25 @@ def is_orport_reachable(latest_consensus, consensuses, votes):
     if not desc:
       continue  # authority isn't in the consensus
 
-    # check the IPv4 ORPort
+    # check the IPv4 ORPort, followed by IPv6 ORPorts
 
-    issue = util.check_reachability(desc.address, desc.or_port)
-
-    if issue:
-      issues.append(Issue(Runlevel.WARNING, 'UNABLE_TO_REACH_ORPORT', authority = authority.nickname, address = desc.address, port = desc.or_port, error = issue, to = [authority]))
-
-    # check the IPv6 ORPorts
+    authorities.append(authority)
+    endpoints.append((desc.address, desc.or_port))
 
     for address, port, is_ipv6 in desc.or_addresses:
-      issue = util.check_reachability(address, port)
+      authorities.append(authority)
+      endpoints.append((address, port))
+
+  issues = []
 
-      if issue:
-        issues.append(Issue(Runlevel.WARNING, 'UNABLE_TO_REACH_ORPORT', authority = authority.nickname, address = address, port = port, error = issue, to = [authority]))
+  for authority, probe in zip(authorities, util.probe_reachability(endpoints)):
+    if probe.error:
+      issues.append(Issue(Runlevel.WARNING, 'UNABLE_TO_REACH_ORPORT', authority = authority.nickname, address = probe.address, port = probe.port, error = probe.error, to = [authority]))
 
   return issues
 
 
-def shared_random_present(latest_consensus, consensuses, votes):
+def shared_random_present(latest_consensus, consensuses, votes, summaries):
   """
   Check that the consensus has shared randomness values necessary for hidden
   services to function.
@@ -859,7 +896,7 @@ def shared_random_present(latest_consensus, consensuses, votes):
   return issues
 
 
-def shared_random_commit_partitioning(latest_consensus, consensuses, votes):
+def shared_random_commit_partitioning(latest_consensus, consensuses, votes, summaries):
   """
   Check that each authority's commitment matches the votes from other
   authorities during the commit phase. The commit phase is 0:00 to 12:00 UTC
@@ -886,7 +923,7 @@ def shared_random_commit_partitioning(latest_consensus, consensuses, votes):
       elif commitment.commit != self_commitments[commitment.identity]:
         issues.append(Issue(Runlevel.WARNING, 'SHARED_RANDOM_COMMITMENT_MISMATCH', authority = authority, their_v3ident = commitment.identity, our_value = commitment.commit, their_value = self_commitments[commitment.identity], to = [authority]))
 
-def shared_random_reveal_partitioning(latest_consensus, consensuses, votes):
+def shared_random_reveal_partitioning(latest_consensus, consensuses, votes, summaries):
   """
   Check that each authority's vote has all commitments during the reveal phase.
   The reveal phase is 12:00 to 0:00 UTC and this just checks near the end of
@@ -926,7 +963,7 @@ def shared_random_reveal_partitioning(latest_consensus, consensuses, votes):
         issues.append(Issue(Runlevel.WARNING, 'SHARED_RANDOM_REVEAL_MISMATCH', authority = authority, their_v3ident = v3ident, our_value = matches[0], their_value = reveal, to = [authority]))
 
 
-def old_dizum_address_reachable(latest_consensus, consensuses, votes):
+def old_dizum_address_reachable(latest_consensus, consensuses, votes, summaries):
   """
   Check that dizum's old address is still reachable...
 
@@ -964,6 +1001,12 @@ def get_votes():
 
 def _get_documents(label, resource):
   documents, times_taken, clock_skew, issues = {}, {}, {}, []
+  queries = collections.OrderedDict()  # authority nickname => query
+  issued_at = {}  # authority nickname => when we issued its query
+
+  # Queries begin downloading in a background thread as soon as they're made,
+  # so issue all of them before blocking on any. This way our runtime is that
+  # of the slowest authority rather than the sum of them all.
 
   for authority in DIRECTORY_AUTHORITIES.values():
 
@@ -973,21 +1016,38 @@ def _get_documents(label, resource):
     if authority.nickname in DIRAUTH_SKIP_CHECKS:
       continue  # checking of authority impaired
 
-    query = downloader.query(
+    issued_at[authority.nickname] = time.time()
+    queries[authority.nickname] = downloader.query(
       resource,
       endpoints = [(authority.address, authority.dir_port)],
       default_params = False,
     )
 
+  for nickname, query in queries.items():
     try:
-      start_time = datetime.datetime.utcnow()
-      documents[authority.nickname] = query.run()[0]
+      documents[nickname] = query.run()[0]
       response_timestamp = datetime.datetime.strptime(query.reply_headers.get('date'), '%a, %d %b %Y %H:%M:%S %Z')
 
-      times_taken[authority.nickname] = (datetime.datetime.utcnow() - start_time).total_seconds()
-      clock_skew[authority.nickname] = abs((start_time - response_timestamp).total_seconds())
+      # Time taken is from when we issued the query until its download
+      # finished. We can't use our clock when run() returns since we may have
+      # been blocked on other authorities, nor stem's runtime since that's
+      # reset with each retry.
+
+      start_time = datetime.datetime.utcfromtimestamp(query.start_time)
+      times_taken[nickname] = query.start_time + query.runtime - issued_at[nickname]
+      clock_skew[nickname] = abs((start_time - response_timestamp).total_seconds())
+    except Exception as exc:
+      issues.append(Issue(Runlevel.ERROR, 'AUTHORITY_UNAVAILABLE', fetch_type = label, authority = nickname, url = query.download_url, error = exc, to = [nickname]))
+
+  if label == 'consensus' and documents:
+    # share the newest consensus with our other scripts so they needn't fetch it
+
+    newest = max(documents, key = lambda nickname: documents[nickname].valid_after)
+
+    try:
+      util.cache_consensus(queries[newest].content)
     except Exception as exc:
-      issues.append(Issue(Runlevel.ERROR, 'AUTHORITY_UNAVAILABLE', fetch_type = label, authority = authority.nickname, url = query.download_url, error = exc, to = [authority.nickname]))
+      log.warn("Unable to cache the consensus from %s: %s" % (newest, exc))
 
   if label == 'consensus' and times_taken:
     median_time = sorted(times_taken.values())[int(len(times_taken) / 2)]
@@ -1004,9 +1064,43 @@ def _get_documents(label, resource):
   return documents, issues
 
 
+# Checks performed by run_checks(), and the subset of those that contact the
+# authorities rather than just examine their documents.
+
+NETWORK_CHECKERS = (
+  is_orport_reachable,
+  old_dizum_address_reachable,
+)
+
+CHECKER_FUNCTIONS = (
+  missing_latest_consensus,
+  missing_authority_descriptor,
+  consensus_method_unsupported,
+  different_recommended_client_version,
+  different_recommended_server_version,
+  #unknown_consensus_parameters,  # tor is fiddling with these quite a bit, #24895
+  #vote_parameters_mismatch_consensus,
+  certificate_expiration,
+  consensuses_have_same_votes,
+  has_all_signatures,
+  voting_bandwidth_scanners,
+  #unmeasured_relays,
+  has_authority_flag,
+  has_similar_flag_counts,
+  is_recommended_versions,
+  bad_exits_in_sync,
+  bandwidth_authorities_in_sync,
+  is_orport_reachable,
+  shared_random_present,
+  shared_random_commit_partitioning,
+  shared_random_reveal_partitioning,
+  old_dizum_address_reachable,
+)
+
+
 if __name__ == '__main__':
   try:
-    main()
+    util.profile('consensus_health_checker', main)
   except:
     msg = "consensus_health_checker.py failed with:\n\n%s" % traceback.format_exc()
     log.error(msg)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# Copyright 2020, The Tor Project
+# See LICENSE for licensing information
+
+"""
+Runs our consensus health checks against archived documents rather than the
+live authorities. This lets us reproduce past incidents and benchmark our
+checks without network access...
+
+  % python consensus_health_replay.py /path/to/documents
+
+The directory should contain files named '<authority>-consensus' and
+'<authority>-vote'. These may be zlib compressed with a '.z' suffix, as
+served by the authorities...
+
+  % curl http://128.31.0.39:9131/tor/status-vote/current/consensus.z > moria1-consensus.z
+  % curl http://128.31.0.39:9131/tor/status-vote/current/authority.z > moria1-vote.z
+
+Checks that contact the authorities are skipped. Checks relative to the
+current time (such as consensus freshness) will reflect these documents' age.
+"""
+
+import io
+import os
+import sys
+import time
+import zlib
+
+import stem.descriptor
+import stem.util.conf
+
+import consensus_health_checker
+import util
+
+DOCUMENT_TYPES = {
+  'consensus': 'network-status-consensus-3 1.0',
+  'vote': 'network-status-vote-3 1.0',
+}
+
+
+def main(path):
+  config = stem.util.conf.get_config('consensus_health')
+  config.load(util.get_path('data', 'consensus_health.cfg'))
+
+  timings = {}
+  consensuses, votes = load_documents(path, timings)
+
+  if not consensuses or not votes:
+    raise ValueError('%s needs both consensuses and votes to run our checks' % path)
+
+  checker_functions = [c for c in consensus_health_checker.CHECKER_FUNCTIONS if c not in consensus_health_checker.NETWORK_CHECKERS]
+
+  start_time = time.time()
+  issues = consensus_health_checker.run_checks(consensuses, votes, checker_functions, timings)
+  timings['run_checks'] = time.time() - start_time
+
+  print('Replayed %i consensuses and %i votes from %s' % (len(consensuses), len(votes), path))
+  print('')
+
+  if issues:
+    for issue in issues:
+      print(issue)
+  else:
+    print('No issues found.')
+
+  print('')
+  print('Timings:')
+
+  for stage, runtime in sorted(timings.items(), key = lambda entry: entry[1], reverse = True):
+    print('  %-40s %0.3fs' % (stage, runtime))
+
+
+def load_documents(path, timings):
+  """
+  Reads the archived consensuses and votes within a directory.
+
+  :param str path: directory with our documents
+  :param dict timings: populated with the seconds taken to read each
+    document type
+
+  :returns: tuple of the form ({authority => consensus}, {authority => vote})
+
+  :raises:
+    * **IOError** if unable to read the documents
+    * **ValueError** if a document is malformed or from an unrecognized
+      authority
+  """
+
+  documents = dict((doc_type, {}) for doc_type in DOCUMENT_TYPES)
+
+  for filename in sorted(os.listdir(path)):
+    name = filename[:-2] if filename.endswith('.z') else filename
+
+    if '-' not in name:
+      continue
+
+    authority, doc_type = name.rsplit('-', 1)
+
+    if doc_type not in DOCUMENT_TYPES:
+      continue
+    elif authority not in consensus_health_checker.DIRECTORY_AUTHORITIES:
+      raise ValueError("%s isn't from a directory authority we recognize (%s)" % (filename, authority))
+
+    start_time = time.time()
+
+    with open(os.path.join(path, filename), 'rb') as document_file:
+      content = document_file.read()
+
+    if filename.endswith('.z'):
+      content = zlib.decompress(content, zlib.MAX_WBITS | 32)
+
+    documents[doc_type][authority] = list(stem.descriptor.parse_file(
+      io.BytesIO(content),
+      DOCUMENT_TYPES[doc_type],
+      document_handler = stem.descriptor.DocumentHandler.DOCUMENT,
+    ))[0]
+
+    stage = 'parse %s' % doc_type
+    timings[stage] = timings.get(stage, 0) + time.time() - start_time
+
+  return documents['consensus'], documents['vote']
+
+
+if __name__ == '__main__':
+  if len(sys.argv) != 2 or not os.path.isdir(sys.argv[1]):
+    print('Usage: %s /path/to/documents' % sys.argv[0])
+    sys.exit(1)
+
+  main(sys.argv[1])
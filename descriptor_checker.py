@@ -10,14 +10,22 @@ issues an email notification when a problem is discovered.
 """
 
 import datetime
+import io
+import multiprocessing
 import os
+import re
 import traceback
 
+from multiprocessing.pool import ThreadPool
+
 import util
 
 import stem.descriptor
+import stem.descriptor.extrainfo_descriptor
 import stem.descriptor.remote
-import stem.directory
+import stem.descriptor.server_descriptor
+
+from stem.descriptor.remote import MAX_FINGERPRINTS
 
 EMAIL_SUBJECT = 'Unable to retrieve tor descriptors'
 
@@ -29,64 +37,133 @@ time: %s
 error: %s
 """
 
+VALIDATION_SUBJECT = 'Malformed tor descriptors'
+
+VALIDATION_BODY = """\
+%i of the %i present %s from %s are malformed...
+
+%s
+"""
+
+MAX_REPORTED_FAILURES = 50  # failures listed within a notification
+
+SUPPRESSED_ERRORS = (
+  "'dirreq-v3-ips' line had non-ascii content",  # https://trac.torproject.org/projects/tor/ticket/16858
+  'Entries in dirreq-v3-ips line should only be',
+)
+
 DIRAUTH_SKIP_CHECKS = (
   'tor26',   # tor26 DirPort does not service requests without a .z suffix
   'dannenberg', # al asked for skipping the checks for now (2020-06-18)
 )
 
+CONCURRENCY = 12  # downloads we'll run at once, enough for all authorities
+VALIDATION_PROCESSES = multiprocessing.cpu_count()  # processes we validate descriptors with
+DESCRIPTORS_PER_CHUNK = 250  # descriptors each process validates at a time
+
+# Descriptor types we validate, with the line each starts with and the line
+# providing its fingerprint.
+
+DESCRIPTOR_BOUNDARIES = {
+  'server-descriptor 1.0': re.compile(b'^router ', re.MULTILINE),
+  'extra-info 1.0': re.compile(b'^extra-info ', re.MULTILINE),
+}
+
+DESCRIPTOR_CLASSES = {
+  'server-descriptor 1.0': stem.descriptor.server_descriptor.RelayDescriptor,
+  'extra-info 1.0': stem.descriptor.extrainfo_descriptor.RelayExtraInfoDescriptor,
+}
+
+DESCRIPTOR_FINGERPRINTS = {
+  'server-descriptor 1.0': re.compile(b'^fingerprint ((?:[0-9A-F]{4} ?){10})', re.MULTILINE),
+  'extra-info 1.0': re.compile(b'^extra-info \\S+ ([0-9A-F]{40})', re.MULTILINE),
+}
+
+VALIDATED_DIGESTS_PATH = util.get_path('data', 'validated_descriptor_digests')
+
 log = util.get_logger('descriptor_checker')
 util.log_stem_debugging('descriptor_checker')
 
 
 def main():
-  # retrieve the server and extrainfo descriptors from any authority
+  authorities = util.get_authorities()
+  endpoints = [(auth.address, auth.dir_port) for auth in authorities.values() if auth.nickname not in stem.descriptor.remote.DIR_PORT_BLACKLIST]
 
-  targets = [
-    ('server descriptors', '/tor/server/all.z'),
-    ('extrainfo descriptors', '/tor/extra/all.z'),
-  ]
+  # validation is cpu bound, so spread it across our cores (process pool is
+  # made first so it doesn't fork our download threads)
 
-  for descriptor_type, resource in targets:
-    log.debug("Downloading %s..." % descriptor_type)
+  process_pool = multiprocessing.Pool(VALIDATION_PROCESSES) if VALIDATION_PROCESSES > 1 else None
+  pool = ThreadPool(CONCURRENCY)
 
-    query = stem.descriptor.remote.Query(
-      resource,
-      block = True,
-      timeout = 60,
-      validate = True,
-    )
+  # Descriptors we validated in prior runs are skipped, so we only download
+  # those that are new to the consensus. Extrainfo descriptors are listed by
+  # server descriptors, so we fetch those after.
+  #
+  # If we lack prior results or the consensus then we download everything
+  # from any authority.
 
-    if not query.error:
-      count = len(list(query))
-      log.debug("  %i descriptors retrieved from %s in %0.2fs" % (count, query.download_url, query.runtime))
-    elif "'dirreq-v3-ips' line had non-ascii content" in str(query.error) or "Entries in dirreq-v3-ips line should only be" in str(query.error):
-      log.debug("Suppressing error due to malformed dirreq-v3-ips line: https://trac.torproject.org/projects/tor/ticket/16858")
-    else:
-      log.warn("Unable to retrieve the %s: %s" % (descriptor_type, query.error))
-      send_email(EMAIL_SUBJECT, descriptor_type, query)
+  validated = load_validated_digests()
+
+  try:
+    present = set([relay.digest for relay in util.get_relays()])
+  except (IOError, ValueError) as exc:
+    log.warn("Unable to retrieve the consensus, checking all descriptors: %s" % exc)
+    present = None
+
+  if validated and present is not None:
+    validated = dict([(digest, extra_info_digest) for digest, extra_info_digest in validated.items() if digest in present])
+    server_resources = get_digest_resources('/tor/server/d/', [digest for digest in present if digest not in validated])
+    extra_resources = None
+  else:
+    validated = {}
+    server_resources = ['/tor/server/all.z']
+    extra_resources = ['/tor/extra/all.z']
+
+  server_results = [pool.apply_async(check_descriptors, ('server descriptors', resource, endpoints, process_pool)) for resource in server_resources]
+
+  if extra_resources is not None:
+    extra_results = [pool.apply_async(check_descriptors, ('extrainfo descriptors', resource, endpoints, process_pool)) for resource in extra_resources]
 
   # download the consensus from each authority
 
-  for authority in stem.directory.Authority.from_cache().values():
+  consensus_results = []
+
+  for authority in authorities.values():
     if authority.v3ident is None:
       continue  # authority doesn't vote in the consensus
     elif authority.nickname in DIRAUTH_SKIP_CHECKS:
       continue  # checking of authority impaired
 
-    log.debug("Downloading the consensus from %s..." % authority.nickname)
+    consensus_results.append((authority, pool.apply_async(check_consensus, (authority,))))
+
+  server_digests = report_descriptors('server descriptors', [result.get() for result in server_results])
+
+  if extra_resources is None:
+    extra_info_digests = [extra_info_digest for extra_info_digest in server_digests.values() if extra_info_digest]
+    extra_results = [pool.apply_async(check_descriptors, ('extrainfo descriptors', resource, endpoints, process_pool)) for resource in get_digest_resources('/tor/extra/d/', extra_info_digests)]
+
+  pool.close()
+  extra_digests = report_descriptors('extrainfo descriptors', [result.get() for result in extra_results])
 
-    query = stem.descriptor.remote.Query(
-      '/tor/status-vote/current/consensus.z',
-      block = True,
-      timeout = 60,
-      endpoints = [(authority.address, authority.dir_port)],
-      document_handler = stem.descriptor.DocumentHandler.DOCUMENT,
-      validate = True,
-    )
+  if process_pool:
+    process_pool.close()
+
+  for digest, extra_info_digest in server_digests.items():
+    if (present is None or digest in present) and (not extra_info_digest or extra_info_digest in extra_digests):
+      validated[digest] = extra_info_digest
+
+  save_validated_digests(validated)
+
+  for authority, result in consensus_results:
+    query, count = result.get()
 
     if not query.error:
-      count = len(list(query)[0].routers)
-      log.debug("  %i descriptors retrieved from %s in %0.2fs" % (count, query.download_url, query.runtime))
+      log.debug("  %i router status entries retrieved from %s in %0.2fs" % (count, query.download_url, query.runtime))
+
+      try:
+        util.cache_consensus(query.content)
+      except Exception as exc:
+        log.warn("Unable to cache the consensus from %s: %s" % (authority.nickname, exc))
     else:
       log.warn("Unable to retrieve the consensus from %s: %s" % (authority.nickname, query.error))
 
@@ -94,6 +171,235 @@ def main():
       send_email(subject, 'consensus', query)
 
 
+def report_descriptors(descriptor_type, results):
+  """
+  Logs and notifies for the results of our descriptor downloads.
+
+  :param str descriptor_type: description of what we downloaded
+  :param list results: (query, count, failures, digests) tuples from
+    :func:`~descriptor_checker.check_descriptors`
+
+  :returns: **dict** of the digests we validated, as provided by
+    :func:`~descriptor_checker.validate_descriptors`
+  """
+
+  count, failures, digests, failed_queries = 0, [], {}, []
+
+  for query, query_count, query_failures, query_digests in results:
+    if query.error:
+      log.warn("Unable to retrieve the %s from %s: %s" % (descriptor_type, query.download_url, query.error))
+      failed_queries.append(query)
+      continue
+
+    log.debug("  %i %s retrieved from %s in %0.2fs" % (query_count, descriptor_type, query.download_url, query.runtime))
+
+    count += query_count
+    failures += query_failures
+    digests.update(query_digests)
+
+  if failures:
+    log.warn("%i of the %i %s are malformed" % (len(failures), count, descriptor_type))
+    source = results[0][0].download_url if len(results) == 1 else '%i requests' % len(results)
+    send_validation_email(descriptor_type, source, count, failures)
+
+  if failed_queries:
+    send_email(EMAIL_SUBJECT, descriptor_type, failed_queries[0])
+
+  return digests
+
+
+def check_descriptors(descriptor_type, resource, endpoints, process_pool = None):
+  """
+  Downloads and validates descriptors from any of the given endpoints.
+
+  :param str descriptor_type: description of what we're downloading
+  :param str resource: resource to download
+  :param list endpoints: (address, dir_port) tuples we can download from
+  :param multiprocessing.Pool process_pool: pool to validate with, if
+    **None** we validate within this thread
+
+  :returns: **tuple** of the form (query, count, failures, digests)
+  """
+
+  log.debug("Downloading %s..." % descriptor_type)
+
+  query = stem.descriptor.remote.Query(
+    resource,
+    timeout = 60,
+    validate = False,
+    endpoints = endpoints,
+  )
+
+  # stem can't await a download without parsing it, so stop at the first
+  # descriptor then validate the raw content ourselves
+
+  for desc in query:
+    break
+
+  if query.error or not query.content:
+    return query, 0, [], {}
+
+  if process_pool:
+    count, failures, digests = validate_descriptors_in_parallel(query.descriptor_type, query.content, process_pool)
+  else:
+    count, failures, digests = validate_descriptors(query.descriptor_type, query.content)
+
+  return query, count, failures, digests
+
+
+def get_digest_resources(prefix, digests):
+  """
+  Provides the resources to download descriptors by their digest, batched by
+  the maximum number of digests a request can include.
+
+  :param str prefix: resource prefix, such as '/tor/server/d/'
+  :param list digests: hex digests of the descriptors we want
+
+  :returns: **list** of resources to download
+  """
+
+  digests = sorted(digests)
+  return ['%s%s.z' % (prefix, '+'.join(digests[i:i + MAX_FINGERPRINTS])) for i in range(0, len(digests), MAX_FINGERPRINTS)]
+
+
+def load_validated_digests():
+  """
+  Provides the descriptors we've previously validated.
+
+  :returns: **dict** mapping server descriptor digests to their extrainfo
+    descriptor's digest (**None** if they lack one)
+  """
+
+  validated = {}
+
+  if os.path.exists(VALIDATED_DIGESTS_PATH):
+    with open(VALIDATED_DIGESTS_PATH) as digests_file:
+      for line in digests_file:
+        if ' ' in line:
+          digest, extra_info_digest = line.split()
+          validated[digest] = extra_info_digest if extra_info_digest != '-' else None
+
+  return validated
+
+
+def save_validated_digests(validated):
+  try:
+    with open(VALIDATED_DIGESTS_PATH, 'w') as digests_file:
+      for digest, extra_info_digest in sorted(validated.items()):
+        digests_file.write('%s %s\n' % (digest, extra_info_digest if extra_info_digest else '-'))
+  except IOError as exc:
+    log.warn("Unable to save our validated descriptor digests: %s" % exc)
+
+
+def check_consensus(authority):
+  """
+  Downloads and validates the consensus of an authority.
+
+  :param stem.directory.Authority authority: authority to download from
+
+  :returns: **tuple** of the form (query, router_status_entry_count)
+  """
+
+  log.debug("Downloading the consensus from %s..." % authority.nickname)
+
+  query = stem.descriptor.remote.Query(
+    '/tor/status-vote/current/consensus.z',
+    block = True,
+    timeout = 60,
+    endpoints = [(authority.address, authority.dir_port)],
+    document_handler = stem.descriptor.DocumentHandler.DOCUMENT,
+    validate = True,
+  )
+
+  return query, (len(list(query)[0].routers) if not query.error else 0)
+
+
+def validate_descriptors_in_parallel(descriptor_type, content, process_pool):
+  """
+  Splits downloaded content at descriptor boundaries, and validates these
+  chunks across a process pool.
+
+  :param str descriptor_type: stem type of the descriptors
+  :param bytes content: descriptors we've downloaded
+  :param multiprocessing.Pool process_pool: pool to validate with
+
+  :returns: **tuple** of the same form as
+    :func:`~descriptor_checker.validate_descriptors`
+  """
+
+  boundaries = [match.start() for match in DESCRIPTOR_BOUNDARIES[descriptor_type].finditer(content)][DESCRIPTORS_PER_CHUNK::DESCRIPTORS_PER_CHUNK]
+  offsets = [0] + boundaries + [len(content)]
+  chunks = [(descriptor_type, content[start:end]) for start, end in zip(offsets, offsets[1:])]
+
+  count, failures, digests = 0, [], {}
+
+  for chunk_count, chunk_failures, chunk_digests in process_pool.map(_validate_chunk, chunks):
+    count += chunk_count
+    failures += chunk_failures
+    digests.update(chunk_digests)
+
+  return count, failures, digests
+
+
+def _validate_chunk(args):
+  return validate_descriptors(*args)
+
+
+def validate_descriptors(descriptor_type, content):
+  """
+  Validates each descriptor within the content, parsing each just once and
+  only holding one in memory at a time. Failures are recorded rather than
+  ending our validation so a malformed descriptor doesn't hide others.
+
+  :param str descriptor_type: stem type of the descriptors
+  :param bytes content: descriptors we've downloaded
+
+  :returns: **tuple** of the form (count, [(fingerprint, error)...], digests)
+    where digests maps the digest of each valid descriptor to the extrainfo
+    digest it lists (**None** if it lacks one)
+  """
+
+  descriptor_class = DESCRIPTOR_CLASSES[descriptor_type]
+  count, failures, digests = 0, [], {}
+
+  for raw_descriptor in _split_descriptors(descriptor_type, content):
+    count += 1
+
+    try:
+      desc = descriptor_class(raw_descriptor, validate = True)
+    except ValueError as exc:
+      if any(msg in str(exc) for msg in SUPPRESSED_ERRORS):
+        log.debug("Suppressing error due to malformed dirreq-v3-ips line: https://trac.torproject.org/projects/tor/ticket/16858")
+        desc = descriptor_class(raw_descriptor, validate = False)
+      else:
+        match = DESCRIPTOR_FINGERPRINTS[descriptor_type].search(raw_descriptor)
+        failures.append((match.group(1).decode('utf-8').replace(' ', '') if match else None, exc))
+        continue
+
+    digests[desc.digest()] = getattr(desc, 'extra_info_digest', None)
+
+  return count, failures, digests
+
+
+def _split_descriptors(descriptor_type, content):
+  starts = [match.start() for match in DESCRIPTOR_BOUNDARIES[descriptor_type].finditer(content)]
+
+  for start, end in zip(starts, starts[1:] + [len(content)]):
+    yield content[start:end]
+
+
+def send_validation_email(descriptor_type, source, count, failures):
+  lines = ['* %s: %s' % (fingerprint, exc) for fingerprint, exc in failures[:MAX_REPORTED_FAILURES]]
+
+  if len(failures) > MAX_REPORTED_FAILURES:
+    lines.append('... and %i more' % (len(failures) - MAX_REPORTED_FAILURES))
+
+  try:
+    util.send(VALIDATION_SUBJECT, body = VALIDATION_BODY % (len(failures), count, descriptor_type, source, '\n'.join(lines)), to = [util.ERROR_ADDRESS])
+  except Exception as exc:
+    log.warn("Unable to send email: %s" % exc)
+
+
 def send_email(subject, descriptor_type, query):
   try:
     timestamp = datetime.datetime.now().strftime("%m/%d/%Y %H:%M")
@@ -104,7 +410,7 @@ def send_email(subject, descriptor_type, query):
 
 if __name__ == '__main__':
   try:
-    main()
+    util.profile('descriptor_checker', main)
   except:
     msg = "descriptor_checker.py failed with:\n\n%s" % traceback.format_exc()
     log.error(msg)
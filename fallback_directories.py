@@ -6,11 +6,18 @@
 Report for how many of our fallback directories are unreachable.
 """
 
+import threading
 import time
 import traceback
 
-import stem.descriptor.remote
-import stem.directory
+import stem
+
+from multiprocessing.pool import ThreadPool
+
+try:
+  import urllib.request as urllib  # python 3
+except ImportError:
+  import urllib2 as urllib  # python 2
 
 import util
 
@@ -21,45 +28,112 @@ TO_ADDRESSES = ['tor-consensus-health@lists.torproject.org', 'dgoulet@torproject
 EMAIL_SUBJECT = 'Fallback Directory Summary (%i/%i, %i%%)'
 SYNOPSIS = '%i/%i (%i%%) fallback directories have become slow or unresponsive...'
 
-downloader = stem.descriptor.remote.DescriptorDownloader(timeout = 30)
+CONCURRENCY = 16  # fallbacks we'll download from at once
+BANDWIDTH_LIMIT = 2 * 1024 * 1024  # bytes per second we'll download across all fallbacks, zero if unlimited
+
+# Rather than download the whole consensus from each fallback we read its
+# start, judging the fallback by its time to first byte and throughput. TCP
+# slow start holds down the throughput of such a short read, so our minimum is
+# below what a full download would need.
+
+PROBE_BYTES = 128 * 1024  # bytes to read, zero to download the whole consensus
+PROBE_RESOURCE = '/tor/status-vote/current/consensus.z'
+MAX_FIRST_BYTE_TIME = 5  # seconds
+MIN_THROUGHPUT = 50 * 1024  # bytes per second
+CONSENSUS_SIZE = 1024 * 1024  # rough bytes in a compressed consensus, until we've downloaded one
+
+
+class RateLimiter(object):
+  """
+  Paces the start of our downloads so together they stay under a bandwidth
+  limit. Each download reserves bandwidth for the size we expect, which is
+  corrected once we know how much it actually received.
+  """
+
+  def __init__(self, limit, expected_size):
+    self._limit = limit
+    self._lock = threading.Lock()
+    self._next_start = time.time()
+    self._download_size = expected_size
+
+  def wait(self):
+    """
+    Blocks until we can start another download.
+
+    :returns: **int** with the bytes we reserved for this download
+    """
+
+    if not self._limit:
+      return 0
+
+    with self._lock:
+      reserved = self._download_size
+      start_time = max(time.time(), self._next_start)
+      self._next_start = start_time + float(reserved) / self._limit
+
+    time.sleep(max(0, start_time - time.time()))
+    return reserved
+
+  def record(self, received, reserved, is_complete):
+    """
+    Notes the bytes a download received, including failed downloads.
+
+    :param int received: bytes we read from the wire
+    :param int reserved: bytes provided by our wait() for this download
+    :param bool is_complete: if the download finished, in which case we
+      expect others to be of its size
+    """
+
+    if not self._limit:
+      return
+
+    with self._lock:
+      self._next_start += float(received - reserved) / self._limit
+
+      if is_complete:
+        self._download_size = received
 
 
 def main():
   try:
-    fallback_directories = stem.directory.Fallback.from_remote().values()
+    fallback_directories = util.get_fallbacks().values()
     log.info('Retrieved %i fallback directories' % len(fallback_directories))
   except IOError as exc:
     raise IOError("Unable to determine tor's fallback directories: %s" % exc)
 
-  issues = []
+  # Each stage checks all relays that passed the prior one at once. Relays
+  # drop out as soon as they have an issue.
+
+  relay_issues = {}  # fingerprint => issue
+  remaining = list(fallback_directories)
 
-  for relay in fallback_directories:
-    if not util.is_reachable(relay.address, relay.or_port):
-      log.info('%s ORPort unreachable' % relay.fingerprint)
-      issues.append('%s => ORPort is unreachable (%s:%i)' % (relay.fingerprint, relay.address, relay.or_port))
-      continue
+  stages = (
+    ('ORPort', lambda relay: (relay.address, relay.or_port)),
+    ('DirPort', lambda relay: (relay.address, relay.dir_port)),
+    ('IPv6 ORPort', lambda relay: relay.orport_v6),
+  )
 
-    if not util.is_reachable(relay.address, relay.dir_port):
-      log.info('%s DirPort unreachable' % relay.fingerprint)
-      issues.append('%s => DirPort is unreachable (%s:%i)' % (relay.fingerprint, relay.address, relay.dir_port))
-      continue
+  for label, endpoint_for in stages:
+    relays = [relay for relay in remaining if endpoint_for(relay)]
 
-    if relay.orport_v6 and not util.is_reachable(relay.orport_v6[0], relay.orport_v6[1]):
-      log.info('%s IPv6 ORPort unreachable' % relay.fingerprint)
-      issues.append('%s => IPv6 ORPort is unreachable (%s:%i)' % (relay.fingerprint, relay.orport_v6[0], relay.orport_v6[1]))
-      continue
+    for relay, probe in zip(relays, util.probe_reachability([endpoint_for(relay) for relay in relays])):
+      if probe.error:
+        log.info('%s %s unreachable' % (relay.fingerprint, label))
+        relay_issues[relay.fingerprint] = '%s => %s is unreachable (%s:%i)' % (relay.fingerprint, label, probe.address, probe.port)
 
-    try:
-      start = time.time()
-      downloader.get_consensus(endpoints = [(relay.address, relay.dir_port)]).run()
-      download_time = time.time() - start
-      log.info('%s download time was %0.1f seconds' % (relay.fingerprint, download_time))
-    except Exception as exc:
-      issues.append('%s => Unable to download from DirPort (%s)' % (relay.fingerprint, exc))
-      continue
+    remaining = [relay for relay in remaining if relay.fingerprint not in relay_issues]
 
-    if download_time > 15:
-      issues.append('%s => Downloading the consensus took %0.1f seconds' % (relay.fingerprint, download_time))
+  rate_limiter = RateLimiter(BANDWIDTH_LIMIT, PROBE_BYTES if PROBE_BYTES else CONSENSUS_SIZE)
+  pool = ThreadPool(CONCURRENCY)
+
+  check_dirport = check_first_bytes if PROBE_BYTES else check_download
+
+  for relay, issue in zip(remaining, pool.map(lambda relay: check_dirport(relay, rate_limiter), remaining)):
+    if issue:
+      relay_issues[relay.fingerprint] = issue
+
+  pool.close()
+  issues = [relay_issues[relay.fingerprint] for relay in fallback_directories if relay.fingerprint in relay_issues]
 
   issue_percent = 100.0 * len(issues) / len(fallback_directories)
   log.info('%i issues found (%i%%)' % (len(issues), issue_percent))
@@ -87,9 +161,97 @@ def main():
     util.send('Announce or', body = irc_body, to = ['tor-misc@commit.noreply.org'])
 
 
+def check_first_bytes(relay, rate_limiter):
+  """
+  Checks the speed of a fallback by reading the start of its consensus.
+
+  :param stem.directory.Fallback relay: fallback to download from
+  :param RateLimiter rate_limiter: paces our downloads
+
+  :returns: **str** describing the issue if the download fails or is slow,
+    **None** otherwise
+  """
+
+  reserved = rate_limiter.wait()
+  url = 'http://%s:%i%s' % (relay.address, relay.dir_port, PROBE_RESOURCE)
+  received, is_complete = 0, False
+
+  try:
+    start = time.time()
+    response = urllib.urlopen(urllib.Request(url, headers = {'User-Agent': stem.USER_AGENT}), timeout = 30)
+    received = len(response.read(1))
+    first_byte_time = time.time() - start
+
+    while received < PROBE_BYTES:
+      chunk = response.read(min(8192, PROBE_BYTES - received))
+
+      if not chunk:
+        break
+
+      received += len(chunk)
+
+    response.close()
+    is_complete = True
+    transfer_time = time.time() - start - first_byte_time
+    throughput = received / transfer_time if transfer_time > 0 else float('inf')
+    log.info('%s first byte was after %0.1f seconds, throughput was %i KB/s' % (relay.fingerprint, first_byte_time, min(throughput, 1e9) / 1024))
+  except Exception as exc:
+    return '%s => Unable to download from DirPort (%s)' % (relay.fingerprint, exc)
+  finally:
+    rate_limiter.record(received, reserved, is_complete)
+
+  if first_byte_time > MAX_FIRST_BYTE_TIME:
+    return '%s => First byte of the consensus took %0.1f seconds' % (relay.fingerprint, first_byte_time)
+  elif throughput < MIN_THROUGHPUT:
+    return '%s => Consensus downloaded at only %i KB/s' % (relay.fingerprint, throughput / 1024)
+
+
+def check_download(relay, rate_limiter):
+  """
+  Checks how long it takes to download the consensus from a fallback.
+
+  :param stem.directory.Fallback relay: fallback to download from
+  :param RateLimiter rate_limiter: paces our downloads
+
+  :returns: **str** describing the issue if the download fails or is slow,
+    **None** otherwise
+  """
+
+  # Read the compressed consensus ourselves rather than through stem so we
+  # know how many bytes we received.
+
+  reserved = rate_limiter.wait()
+  url = 'http://%s:%i%s' % (relay.address, relay.dir_port, PROBE_RESOURCE)
+  received, is_complete = 0, False
+
+  try:
+    start = time.time()
+    response = urllib.urlopen(urllib.Request(url, headers = {'User-Agent': stem.USER_AGENT}), timeout = 30)
+
+    while True:
+      chunk = response.read(65536)
+
+      if not chunk:
+        break
+
+      received += len(chunk)
+
+    response.close()
+    is_complete = True
+    download_time = time.time() - start
+    log.info('%s download time was %0.1f seconds' % (relay.fingerprint, download_time))
+  except Exception as exc:
+    return '%s => Unable to download from DirPort (%s)' % (relay.fingerprint, exc)
+  finally:
+    rate_limiter.record(received, reserved, is_complete)
+
+  if download_time > 15:
+    return '%s => Downloading the consensus took %0.1f seconds' % (relay.fingerprint, download_time)
+
+
 if __name__ == '__main__':
   try:
-    main()
+    util.profile('fallback_directories', main)
   except:
     msg = "fallback_directories.py failed with:\n\n%s" % traceback.format_exc()
     log.error(msg)
@@ -9,12 +9,13 @@ This can indicate malicious intent toward hidden services.
 
 import datetime
 import os
+import sqlite3
 import time
 import traceback
 
 import util
 
-from stem.descriptor.remote import DescriptorDownloader
+from stem.descriptor.remote import DescriptorDownloader, MAX_FINGERPRINTS
 from stem.util import datetime_to_unix, conf
 
 EMAIL_SUBJECT = 'Relays Changing Fingerprint'
@@ -24,7 +25,8 @@ The following relays are frequently changing their fingerprints...
 
 """
 
-FINGERPRINT_CHANGES_FILE = util.get_path('data', 'fingerprint_changes')
+FINGERPRINT_CHANGES_FILE = util.get_path('data', 'fingerprint_changes.sqlite')
+LEGACY_FINGERPRINT_CHANGES_FILE = util.get_path('data', 'fingerprint_changes')  # stem config, used by prior versions
 ONE_DAY = 24 * 60 * 60
 TEN_DAYS = 10 * 24 * 60 * 60
 
@@ -40,41 +42,36 @@ def main():
   else:
     last_notified_config._path = last_notified_path
 
+  try:
+    consensus = util.get_relays(timeout = 15)
+  except (IOError, ValueError) as exc:
+    log.warn("Unable to retrieve the consensus: %s" % exc)
+    return
+
   fingerprint_changes = load_fingerprint_changes()
+  expire_fingerprint_changes(fingerprint_changes, time.time() - TEN_DAYS)
   downloader = DescriptorDownloader(timeout = 15)
   alarm_for = {}
 
-  for relay in downloader.get_consensus():
-    prior_fingerprints = fingerprint_changes.setdefault((relay.address, relay.or_port), {})
-
-    if relay.fingerprint not in prior_fingerprints:
+  for relay in consensus:
+    if not has_fingerprint(fingerprint_changes, relay.address, relay.or_port, relay.fingerprint):
       log.debug("Registering a new fingerprint for %s:%s (%s)" % (relay.address, relay.or_port, relay.fingerprint))
-      prior_fingerprints[relay.fingerprint] = datetime_to_unix(relay.published)
-
-      # drop fingerprint changes that are over thirty days old
-
-      old_fingerprints = [fp for fp in prior_fingerprints if (time.time() - prior_fingerprints[fp] > TEN_DAYS)]
-
-      for fp in old_fingerprints:
-        log.debug("Removing fingerprint for %s:%s (%s) which was published %i days ago" % (relay.address, relay.or_port, fp, prior_fingerprints[fp] / 60 / 60 / 24))
-        del prior_fingerprints[fp]
+      add_fingerprint(fingerprint_changes, relay.address, relay.or_port, relay.fingerprint, datetime_to_unix(relay.published))
 
       # if we've changed more than ten times in the last ten days then alarm
 
-      if len(prior_fingerprints) >= 10:
+      if len(get_fingerprints(fingerprint_changes, relay.address, relay.or_port)) >= 10:
         alarm_for['%s:%s' % (relay.address, relay.or_port)] = (relay.address, relay.or_port, relay.fingerprint)
 
   if alarm_for and not is_notification_suppressed(alarm_for.values()):
     log.debug("Sending a notification for %i relays..." % len(alarm_for))
     body = EMAIL_BODY
+    descriptors = get_server_descriptors(downloader, [fingerprint for _, _, fingerprint in alarm_for.values()])
 
     for address, or_port, fingerprint in alarm_for.values():
-      try:
-        desc = downloader.get_server_descriptors(fingerprint).run()[0]
-      except:
-        desc = None  # might not be available, just used for extra info
+      desc = descriptors.get(fingerprint)  # might not be available, just used for extra info
 
-      fp_changes = fingerprint_changes[(address, or_port)]
+      fp_changes = get_fingerprints(fingerprint_changes, address, or_port)
       log.debug("* %s:%s has had %i fingerprints: %s" % (address, or_port, len(fp_changes), ', '.join(fp_changes.keys())))
 
       if desc:
@@ -118,48 +115,120 @@ def main():
   save_fingerprint_changes(fingerprint_changes)
 
 
+def get_server_descriptors(downloader, fingerprints):
+  """
+  Provides the server descriptors of the given relays. These are requested
+  in batches, all of which are downloaded concurrently.
+
+  :param stem.descriptor.remote.DescriptorDownloader downloader: downloader to use
+  :param list fingerprints: fingerprints of the relays we want
+
+  :returns: **dict** of fingerprints to their server descriptor, this lacks
+    any we were unable to retrieve
+  """
+
+  queries = [downloader.get_server_descriptors(fingerprints[i:i + MAX_FINGERPRINTS]) for i in range(0, len(fingerprints), MAX_FINGERPRINTS)]
+  descriptors = {}
+
+  for query in queries:
+    try:
+      for desc in query.run():
+        descriptors[desc.fingerprint] = desc
+    except Exception as exc:
+      log.debug("Unable to retrieve server descriptors from %s: %s" % (query.download_url, exc))
+
+  return descriptors
+
+
 def load_fingerprint_changes():
   """
-  Loads information about prior fingerprint changes we've persisted. This
-  provides a dictionary of the form...
+  Opens the sqlite database where we persist prior fingerprint changes. Its
+  table is indexed by relay and publication time, so each run only reads and
+  writes the entries it needs rather than our whole history. Changes are
+  saved when we call :func:`~fingerprint_change_checker.save_fingerprint_changes`.
+
+  If our database is empty but we have the stem config of prior versions then
+  it's imported. This is committed right away so a later failure doesn't lose
+  it.
 
-    (address, or_port) => {fingerprint: published_timestamp...}
+  :returns: **sqlite3.Connection** to our database
   """
 
   log.debug("Loading fingerprint changes...")
-  config = conf.get_config('fingerprint_changes')
 
-  try:
-    config.load(FINGERPRINT_CHANGES_FILE)
-    fingerprint_changes = {}
+  fingerprint_changes = sqlite3.connect(FINGERPRINT_CHANGES_FILE)
+  fingerprint_changes.execute('CREATE TABLE IF NOT EXISTS fingerprint_changes (address TEXT, or_port INTEGER, fingerprint TEXT, published REAL, PRIMARY KEY (address, or_port, fingerprint))')
+  fingerprint_changes.execute('CREATE INDEX IF NOT EXISTS published_index ON fingerprint_changes (published)')
 
-    for key in config.keys():
-      address, or_port = key.split(':', 1)
+  is_empty = fingerprint_changes.execute('SELECT 1 FROM fingerprint_changes LIMIT 1').fetchone() is None
 
-      for value in config.get(key, []):
-        fingerprint, published = value.split(':', 1)
-        fingerprint_changes.setdefault((address, int(or_port)), {})[fingerprint] = float(published)
+  if is_empty and os.path.exists(LEGACY_FINGERPRINT_CHANGES_FILE):
+    log.debug("  importing '%s'" % LEGACY_FINGERPRINT_CHANGES_FILE)
+    config = conf.get_config('fingerprint_changes')
 
-    log.debug("  information for %i relays found" % len(fingerprint_changes))
-    return fingerprint_changes
-  except IOError as exc:
-    log.debug("  unable to read '%s': %s" % (FINGERPRINT_CHANGES_FILE, exc))
-    return {}
+    try:
+      config.load(LEGACY_FINGERPRINT_CHANGES_FILE)
 
+      with fingerprint_changes:
+        for key in config.keys():
+          address, or_port = key.split(':', 1)
 
-def save_fingerprint_changes(fingerprint_changes):
-  log.debug("Saving fingerprint changes for %i relays" % len(fingerprint_changes))
-  config = conf.get_config('fingerprint_changes')
-  config.clear()
+          for value in config.get(key, []):
+            fingerprint, published = value.split(':', 1)
+            add_fingerprint(fingerprint_changes, address, int(or_port), fingerprint, float(published))
+    except IOError as exc:
+      log.debug("  unable to read '%s': %s" % (LEGACY_FINGERPRINT_CHANGES_FILE, exc))
+
+  return fingerprint_changes
+
+
+def has_fingerprint(fingerprint_changes, address, or_port, fingerprint):
+  """
+  Checks if we've already seen a relay with the given fingerprint.
+  """
+
+  return fingerprint_changes.execute('SELECT 1 FROM fingerprint_changes WHERE address = ? AND or_port = ? AND fingerprint = ?', (address, or_port, fingerprint)).fetchone() is not None
 
-  for address, or_port in fingerprint_changes:
-    for fingerprint, published in fingerprint_changes[(address, or_port)].items():
-      config.set('%s:%s' % (address, or_port), '%s:%s' % (fingerprint, published), overwrite = False)
 
+def add_fingerprint(fingerprint_changes, address, or_port, fingerprint, published):
+  """
+  Records a fingerprint we've seen for a relay.
+  """
+
+  fingerprint_changes.execute('INSERT OR REPLACE INTO fingerprint_changes VALUES (?, ?, ?, ?)', (address, or_port, fingerprint, published))
+
+
+def get_fingerprints(fingerprint_changes, address, or_port):
+  """
+  Provides the fingerprints we've seen for a relay.
+
+  :returns: **dict** of the form {fingerprint: published_timestamp...}
+  """
+
+  return dict(fingerprint_changes.execute('SELECT fingerprint, published FROM fingerprint_changes WHERE address = ? AND or_port = ?', (address, or_port)))
+
+
+def expire_fingerprint_changes(fingerprint_changes, cutoff):
+  """
+  Drops fingerprints published before the given time, for all relays rather
+  than just those that are presently changing. Our publication time index
+  means this only visits the entries that have expired.
+
+  :param sqlite3.Connection fingerprint_changes: fingerprint changes to be pruned
+  :param float cutoff: unix timestamp before which we drop fingerprints
+  """
+
+  expired_count = fingerprint_changes.execute('DELETE FROM fingerprint_changes WHERE published < ?', (cutoff,)).rowcount
+  log.debug("Removed %i fingerprints that were published over ten days ago" % expired_count)
+
+
+def save_fingerprint_changes(fingerprint_changes):
   try:
-    config.save(FINGERPRINT_CHANGES_FILE)
-  except IOError as exc:
+    fingerprint_changes.commit()
+  except sqlite3.Error as exc:
     log.debug("  unable to save '%s': %s" % (FINGERPRINT_CHANGES_FILE, exc))
+  finally:
+    fingerprint_changes.close()
 
 
 def is_notification_suppressed(fingerprint_changes):
@@ -187,7 +256,7 @@ def is_notification_suppressed(fingerprint_changes):
 
 if __name__ == '__main__':
   try:
-    main()
+    util.profile('fingerprint_change_checker', main)
   except:
     msg = "fingerprint_change_checker.py failed with:\n\n%s" % traceback.format_exc()
     log.error(msg)
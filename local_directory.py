@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# Copyright 2020, The Tor Project
+# See LICENSE for licensing information
+
+"""
+Local stand-in for the directory authorities, serving archived documents so
+we can exercise our scripts without live authorities. Faults such as latency,
+bandwidth caps, truncation and errors are injected as configured in
+data/local_directory.cfg...
+
+  % python local_directory.py /path/to/archive 9030
+  % DOCTOR_DIRECTORY_OVERRIDE=127.0.0.1:9030 python consensus_health_checker.py
+
+Files are served by their resource path within the archive, for instance
+'/path/to/archive/tor/status-vote/current/consensus.z'. A '.z' file also
+serves requests without that suffix. Like tor we respond with deflate
+encoding if the resource has a '.z' suffix or the client accepts it.
+
+Each authority (sorted by nickname) listens on successive ports from the one
+we're given, followed by a port shared by all fallback directories. This is
+the same order util.get_authorities() and util.get_fallbacks() expect.
+"""
+
+import os
+import sys
+import threading
+import time
+import zlib
+
+import stem.directory
+import stem.util.conf
+
+import util
+
+try:
+  import http.server as BaseHTTPServer  # python 3
+  import socketserver as SocketServer
+except ImportError:
+  import BaseHTTPServer  # python 2
+  import SocketServer
+
+CONFIG = stem.util.conf.config_dict('local_directory', {
+  'latency': {},
+  'bandwidth': {},
+  'truncate': {},
+  'error': {},
+})
+
+CHUNKS_PER_SECOND = 10  # granularity with which we rate limit
+
+log = util.get_logger('local_directory')
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  request_queue_size = 128  # fallbacks share a port, so we're sent many connections at once
+
+
+def main(archive, port):
+  config = stem.util.conf.get_config('local_directory')
+  config.load(util.get_path('data', 'local_directory.cfg'))
+
+  nicknames = sorted(stem.directory.Authority.from_cache()) + ['fallbacks']
+
+  for i, nickname in enumerate(nicknames):
+    server = ThreadedHTTPServer(('127.0.0.1', port + i), handler_for(archive, nickname))
+
+    server_thread = threading.Thread(target = server.serve_forever, name = nickname)
+    server_thread.daemon = True
+    server_thread.start()
+
+    print('Serving %s on port %i' % (nickname, port + i))
+
+  try:
+    while True:
+      time.sleep(1)
+  except KeyboardInterrupt:
+    pass
+
+
+def handler_for(archive, nickname):
+  """
+  Provides a request handler serving documents as the given directory.
+
+  :param str archive: directory with the documents we serve
+  :param str nickname: directory we're acting as
+
+  :returns: **BaseHTTPRequestHandler** subclass
+  """
+
+  class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+      resource = self.path.split('?', 1)[0]
+
+      latency = float(get_setting('latency', nickname, resource))
+      bandwidth = int(get_setting('bandwidth', nickname, resource))
+      truncate = int(get_setting('truncate', nickname, resource))
+      error = int(get_setting('error', nickname, resource))
+
+      if latency:
+        time.sleep(latency)
+
+      if error:
+        self.send_error(error)
+        return
+
+      path = os.path.join(archive, resource.lstrip('/'))
+
+      if os.path.isfile(path):
+        is_compressed = path.endswith('.z')
+      elif os.path.isfile(path + '.z'):
+        path, is_compressed = path + '.z', True
+      else:
+        self.send_error(404)
+        return
+
+      with open(path, 'rb') as document_file:
+        content = document_file.read()
+
+      if resource.endswith('.z') or 'deflate' in self.headers.get('Accept-Encoding', ''):
+        encoding = 'deflate'
+        content = content if is_compressed else zlib.compress(content)
+      else:
+        encoding = 'identity'
+        content = zlib.decompress(content) if is_compressed else content
+
+      self.send_response(200)
+      self.send_header('Content-Type', 'text/plain')
+      self.send_header('Content-Encoding', encoding)
+      self.send_header('Content-Length', str(len(content)))
+      self.end_headers()
+
+      if truncate:
+        content = content[:truncate]
+
+      chunk_size = max(1, bandwidth // CHUNKS_PER_SECOND) if bandwidth else len(content)
+
+      for i in range(0, len(content), chunk_size):
+        self.wfile.write(content[i:i + chunk_size])
+
+        if bandwidth:
+          time.sleep(1.0 / CHUNKS_PER_SECOND)
+
+      if truncate:
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+      log.debug('%s: %s' % (nickname, format % args))
+
+  return Handler
+
+
+def get_setting(key, nickname, resource):
+  """
+  Provides the most specific configured value for a request.
+
+  :param str key: setting to provide
+  :param str nickname: directory that's being requested from
+  :param str resource: path that's being requested
+
+  :returns: **str** with the configured value
+  """
+
+  for setting in (nickname + resource, resource, nickname, '*'):
+    if setting in CONFIG[key]:
+      return CONFIG[key][setting]
+
+  return '0'
+
+
+if __name__ == '__main__':
+  if len(sys.argv) != 3 or not os.path.isdir(sys.argv[1]) or not sys.argv[2].isdigit():
+    print('Usage: %s /path/to/archive port' % sys.argv[0])
+    sys.exit(1)
+
+  main(sys.argv[1], int(sys.argv[2]))
@@ -8,13 +8,25 @@ Checks for outdated versions on the packages wiki...
   https://trac.torproject.org/projects/tor/wiki/doc/packages
 """
 
+import codecs
 import collections
+import json
+import os
 import re
+import socket
 import time
-import urllib2
+
+from multiprocessing.pool import ThreadPool
 
 import util
 
+try:
+  import http.client as httplib  # python 3
+  import urllib.parse as urlparse
+except ImportError:
+  import httplib  # python 2
+  import urlparse
+
 MAC_VERSION = '\w*<td>([0-9\.]+)</td>'
 DEBIAN_VERSION = '<h1>Source Package: \S+ \(([0-9\.]+).*\)'
 FEDORA_VERSION = '<div class="package-name">([0-9\.]+).*</div>'
@@ -29,7 +41,23 @@ COLUMN = '| %-10s | %-10s | %-10s | %-50s |'
 DIV = '+%s+%s+%s+%s+' % ('-' * 12, '-' * 12, '-' * 12, '-' * 52)
 TRAC_URL = 'https://trac.torproject.org/projects/tor/wiki/doc/packages'
 
+CONCURRENCY = 8  # pages we'll fetch at once
+PER_HOST_CONCURRENCY = 2  # connections we'll make to any one host
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+# Pages are read in chunks until they match their package's regex. We retain
+# enough of the prior chunk for matches that span them.
+
+SCAN_CHUNK_SIZE = 16 * 1024
+SCAN_OVERLAP = 4096
+SCAN_DRAIN_LIMIT = 64 * 1024  # after a match we read remainders up to this size so the connection can be reused
+
+CACHE_PATH = util.get_path('data', 'package_versions_cache.json')
+CACHE_FALLBACK_AGE = 7 * 24 * 60 * 60  # how long we'll report a cached version if unable to fetch a page
+
 Package = collections.namedtuple('Package', ['platform', 'url', 'regex'])
+Response = collections.namedtuple('Response', ['content', 'etag', 'last_modified'])  # content is None if unmodified, or just the matching text if scanned
 
 PACKAGES = [
   ('tor', [
@@ -92,10 +120,85 @@ PACKAGES = [
 log = util.get_logger('package_versions')
 
 
-def fetch_url(url):
+def fetch_urls(urls, cache = None, patterns = None):
+  """
+  Fetches pages concurrently, making at most PER_HOST_CONCURRENCY connections
+  to each host. Each connection is kept alive for that host's other pages.
+
+  :param list urls: pages to fetch
+  :param dict cache: cache entries from :func:`~package_versions.load_cache`
+    to make conditional requests with
+  :param dict patterns: url => compiled regex to stop reading that page at
+
+  :returns: **dict** mapping urls to their **Response**, or the **IOError**
+    we failed to fetch them with
+  """
+
+  cache = cache if cache is not None else {}
+  patterns = patterns if patterns is not None else {}
+
+  by_host = collections.OrderedDict()
+
+  for url in urls:
+    by_host.setdefault(urlparse.urlsplit(url).netloc, []).append(url)
+
+  # each task is a run of pages we fetch through the same connection
+
+  tasks = []
+
+  for host_urls in by_host.values():
+    task_count = min(PER_HOST_CONCURRENCY, len(host_urls))
+    tasks += [host_urls[i::task_count] for i in range(task_count)]
+
+  pool = ThreadPool(CONCURRENCY)
+  results = {}
+
+  for task_results in pool.map(lambda task: _fetch_all(task, cache, patterns), tasks):
+    results.update(task_results)
+
+  pool.close()
+  return results
+
+
+def _fetch_all(urls, cache, patterns):
+  connections, results = {}, {}
+
+  for url in urls:
+    try:
+      results[url] = fetch_url(url, connections, cache.get(url), patterns.get(url))
+    except IOError as exc:
+      results[url] = exc
+
+  for connection in connections.values():
+    connection.close()
+
+  return results
+
+
+def fetch_url(url, connections = None, cache_entry = None, pattern = None):
+  """
+  Fetches a page, following redirects and retrying on failure. If we have a
+  cached entry for the page then this request is conditional on it having
+  changed. If given a pattern we stop reading the page once it matches, and
+  only provide the matching text.
+
+  :param str url: page to fetch
+  :param dict connections: (scheme, host) => connection to reuse for our
+    requests, and is updated with any we make
+  :param dict cache_entry: cached 'etag' and 'last_modified' of the page
+  :param re.Pattern pattern: compiled regex to scan the page for
+
+  :returns: **Response** for the page
+
+  :raises: **IOError** if unable to fetch the page
+  """
+
+  if connections is None:
+    connections = {}
+
   for i in range(3):
     try:
-      return urllib2.urlopen(url, timeout = 5).read()
+      return _fetch_url(url, connections, cache_entry, pattern)
     except Exception as exc:
       if i < 2:
         time.sleep(2 ** i)
@@ -103,7 +206,148 @@ def fetch_url(url):
         raise IOError(str(exc))
 
 
-def wiki_package_versions():
+def _fetch_url(url, connections, cache_entry, pattern):
+  headers = {}
+
+  if cache_entry and cache_entry.get('etag'):
+    headers['If-None-Match'] = cache_entry['etag']
+
+  if cache_entry and cache_entry.get('last_modified'):
+    headers['If-Modified-Since'] = cache_entry['last_modified']
+
+  for _ in range(MAX_REDIRECTS + 1):
+    scheme, host, path, query, _ = urlparse.urlsplit(url)
+    key = (scheme, host)
+
+    if key not in connections:
+      connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+      connections[key] = connection_class(host, timeout = 5)
+
+    try:
+      connections[key].request('GET', (path or '/') + ('?' + query if query else ''), headers = headers)
+      response = connections[key].getresponse()
+
+      if pattern is not None and 200 <= response.status < 300:
+        content, is_complete = _scan(response, pattern)
+      else:
+        content, is_complete = response.read().decode('utf-8', 'replace'), True
+    except (socket.error, httplib.HTTPException):
+      connections.pop(key).close()  # drop the connection so our retry makes a new one
+      raise
+
+    # connection can't be reused if we didn't read the whole response
+
+    if not is_complete or response.getheader('Connection', '').lower() == 'close':
+      connections.pop(key).close()
+
+    if response.status == 304 and headers:
+      return Response(None, cache_entry.get('etag'), cache_entry.get('last_modified'))
+    elif response.status in REDIRECT_STATUSES and response.getheader('Location'):
+      url = urlparse.urljoin(url, response.getheader('Location'))
+
+      # our cached validators are for the page we requested, not the one
+      # we're redirected to
+
+      headers = {}
+    elif response.status >= 400:
+      raise IOError('HTTP Error %i: %s' % (response.status, response.reason))
+    else:
+      return Response(content, response.getheader('ETag'), response.getheader('Last-Modified'))
+
+  raise IOError('Too many redirects')
+
+
+def _scan(response, pattern):
+  """
+  Reads a response until it matches the given pattern.
+
+  :returns: **tuple** of the form (text, is_complete), where the text is what
+    matched or empty if nothing did, and is_complete indicates if we read the
+    whole response
+  """
+
+  decoder = codecs.getincrementaldecoder('utf-8')('replace')
+  text = ''
+
+  while True:
+    chunk = response.read(SCAN_CHUNK_SIZE)
+    is_complete = not chunk or response.isclosed() or response.length == 0
+    text += decoder.decode(chunk, is_complete)
+    match = pattern.search(text)
+
+    # matches reaching the end of what we've read might continue in our next chunk
+
+    if match and (match.end() < len(text) or is_complete):
+      if not is_complete and response.length is not None and response.length <= SCAN_DRAIN_LIMIT:
+        response.read()
+        is_complete = True
+
+      return match.group(0), is_complete
+    elif is_complete:
+      return '', True
+
+    text = text[min(match.start(), len(text) - SCAN_OVERLAP):] if match else text[-SCAN_OVERLAP:]
+
+
+def load_cache():
+  """
+  Provides our cache of prior responses. Entries are keyed by url and have...
+
+    * etag and last_modified: validators the page was served with
+    * version: what we extracted from the page
+    * fetched: unix timestamp when we last retrieved or validated the page
+
+  :returns: **dict** of cache entries
+  """
+
+  if os.path.exists(CACHE_PATH):
+    try:
+      with open(CACHE_PATH) as cache_file:
+        return json.load(cache_file)
+    except (IOError, ValueError) as exc:
+      log.warn("Unable to read our cache from %s: %s" % (CACHE_PATH, exc))
+
+  return {}
+
+
+def save_cache(cache):
+  try:
+    with open(CACHE_PATH, 'w') as cache_file:
+      json.dump(cache, cache_file, indent = 2, sort_keys = True)
+  except IOError as exc:
+    log.warn("Unable to save our cache to %s: %s" % (CACHE_PATH, exc))
+
+
+def get_version(url, response, cache, extractor):
+  """
+  Provides the version from a page, using our cache if it's unmodified.
+
+  :param str url: page we fetched
+  :param Response response: response for the page
+  :param dict cache: cache entries, updated with the version we extract
+  :param function extractor: provides the version from the page's content
+
+  :returns: version from the page, **None** if it couldn't be determined
+  """
+
+  if response.content is None and url in cache:
+    cache[url]['fetched'] = time.time()
+    return cache[url]['version']
+
+  version = extractor(response.content)
+
+  if version:
+    cache[url] = {
+      'etag': response.etag,
+      'last_modified': response.last_modified,
+      'version': version,
+      'fetched': time.time(),
+    }
+
+  return version
+
+
+def wiki_package_versions(request):
   # Provides versions present on the wiki of the form...
   #
   #   {project => {platform => version}}
@@ -112,7 +356,6 @@ def wiki_package_versions():
   # gonna be very, very brittle. That's fine though - this is just an effort
   # saving measure for me anyway. ;P
 
-  request = fetch_url(TRAC_URL)
   version_entries = []
   expected_count = sum([len(packages) for project, packages in PACKAGES])
 
@@ -154,13 +397,30 @@ def gentoo_version(request):
   return highest_version
 
 
+def package_version(package, request):
+  if package.platform == 'gentoo':
+    return gentoo_version(request)
+  else:
+    match = re.search(package.regex, request)
+    return match.group(1) if match else None
+
+
 def email_content():
   lines = []
   lines.append(DIV)
   lines.append(COLUMN % ('Project', 'Platform', 'Version', 'Status'))
 
+  # fetch all our pages up front, results are then reported in order
+
+  cache = load_cache()
+  patterns = dict([(package.url, re.compile(package.regex)) for _, packages in PACKAGES for package in packages if package.platform != 'gentoo'])
+  pages = fetch_urls([TRAC_URL] + [package.url for _, packages in PACKAGES for package in packages], cache, patterns)
+
   try:
-    wiki_versions = wiki_package_versions()
+    if isinstance(pages[TRAC_URL], IOError):
+      raise pages[TRAC_URL]
+
+    wiki_versions = get_version(TRAC_URL, pages[TRAC_URL], cache, wiki_package_versions)
   except IOError as exc:
     return str(exc), True
 
@@ -175,40 +435,54 @@ def email_content():
       except KeyError:
         return 'Failed to get wiki version for %s on %s' % (project, package.platform), True
 
+      current_version, fetch_error = None, None
+
       try:
-        request = fetch_url(package.url)
+        response = pages[package.url]
 
-        if package.platform == 'gentoo':
-          current_version = gentoo_version(request)
-        else:
-          match = re.search(package.regex, request)
-          current_version = match.group(1) if match else None
+        if isinstance(response, IOError):
+          raise response
 
-        if not current_version:
-          msg = 'unable to determine current version'
-          has_issue = True
-        elif current_version == wiki_version:
-          msg = 'up to date'
-        else:
-          msg = 'current version is %s but wiki has %s' % (current_version, wiki_version)
-          has_issue = True
+        current_version = get_version(package.url, response, cache, lambda content: package_version(package, content))
       except IOError as exc:
-        msg = 'unable to retrieve current version: %s' % exc
+        fetch_error = exc
+        cache_entry = cache.get(package.url)
+
+        # fall back to the version we last saw, so flaky sites aren't noisy
+
+        if cache_entry and time.time() - cache_entry['fetched'] < CACHE_FALLBACK_AGE:
+          current_version = cache_entry['version']
+
+      if fetch_error and not current_version:
+        msg = 'unable to retrieve current version: %s' % fetch_error
 
         # Gentoo's site fails pretty routinely. No need to generate notices for
         # it.
 
         if package.platform != 'gentoo':
           has_issue = True
+      elif not current_version:
+        msg = 'unable to determine current version'
+        has_issue = True
+      elif current_version == wiki_version:
+        msg = 'up to date'
+      else:
+        msg = 'current version is %s but wiki has %s' % (current_version, wiki_version)
+        has_issue = True
+
+      if fetch_error and current_version:
+        msg += ' (last known, unable to retrieve: %s)' % fetch_error
 
       lines.append(COLUMN % (project, package.platform, wiki_version, msg))
 
   lines.append(DIV)
+  save_cache(cache)
+
   return '\n'.join(lines), has_issue
 
 
 if __name__ == '__main__':
-  content, has_issue = email_content()
+  content, has_issue = util.profile('package_versions', email_content)
 
   if has_issue:
     try:
@@ -7,18 +7,24 @@ Simple script that checks to see if there has been a sudden influx of new
 relays. If so then this sends an email notification.
 """
 
+import binascii
+import bisect
+import collections
+import heapq
+import mmap
 import os
 import time
 import traceback
 
 import util
 
-from stem.descriptor.remote import DescriptorDownloader
-
 EMAIL_SUBJECT = 'Possible Sybil Attack'
 
+EMAIL_SUMMARY = 'Over the last %s %i new relays have appeared.\n'
+
 EMAIL_BODY = """\
-Over the last hour %i new relays have appeared. New additions are...
+%s
+New additions are...
 
 """
 
@@ -29,68 +35,345 @@ RELAY_ENTRY = """\
   Exit Policy: %s
 """
 
-FINGERPRINTS_FILE = util.get_path('data', 'fingerprints')
+FINGERPRINTS_FILE = util.get_path('data', 'fingerprints.bin')
+LEGACY_FINGERPRINTS_FILE = util.get_path('data', 'fingerprints')  # newline separated, used by prior versions
+FIRST_SEEN_FILE = util.get_path('data', 'first_seen')
+
+# Hours over which we check for new relays, and how many within that window
+# warrant a notification.
+
+WINDOWS = (
+  (1, 50),
+  (6, 100),
+  (24, 200),
+)
+
+DIGEST_SIZE = 20  # bytes in a binary fingerprint
+COMPACTION_THRESHOLD = 0.01  # merge our journal when it's this fraction of our store
 
 log = util.get_logger('sybil_checker')
 
 
+class FingerprintStore(object):
+  """
+  Every relay fingerprint we've seen. These are kept as sorted 20 byte
+  digests that we memory-map and bisect, so checking membership doesn't
+  require reading the whole file. New fingerprints are appended to a journal
+  that's merged into the store once it grows past COMPACTION_THRESHOLD.
+  """
+
+  def __init__(self, path):
+    self._path = path
+    self._journal_path = path + '.journal'
+    self._file = None
+    self._mmap = None
+    self._journal = set()
+
+    self._open()
+
+  def _open(self):
+    if os.path.exists(self._path) and os.path.getsize(self._path) >= DIGEST_SIZE:
+      self._file = open(self._path, 'rb')
+      self._mmap = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+
+    if os.path.exists(self._journal_path):
+      with open(self._journal_path, 'rb') as journal_file:
+        content = journal_file.read()
+
+      self._journal = set([content[i:i + DIGEST_SIZE] for i in range(0, len(content) - DIGEST_SIZE + 1, DIGEST_SIZE)])
+
+  def close(self):
+    if self._mmap:
+      self._mmap.close()
+      self._file.close()
+
+    self._file, self._mmap = None, None
+
+  def last_modified(self):
+    """
+    Provides when we were last updated.
+
+    :returns: **float** unix timestamp of our last update, **None** if we
+      have never been saved
+    """
+
+    return os.stat(self._path).st_mtime if os.path.exists(self._path) else None
+
+  def merge(self, fingerprints):
+    """
+    Adds fingerprints to our store.
+
+    :param list fingerprints: hex fingerprints to add
+    """
+
+    new_digests = sorted(set([binascii.unhexlify(fp) for fp in fingerprints if fp not in self]))
+
+    if new_digests:
+      with open(self._journal_path, 'ab') as journal_file:
+        journal_file.write(b''.join(new_digests))
+
+      self._journal.update(new_digests)
+
+    if len(self._journal) > COMPACTION_THRESHOLD * len(self._digests()):
+      self._compact()
+
+    # Our modification time reflects when we last ran, even if nothing's new.
+
+    with open(self._path, 'ab'):
+      os.utime(self._path, None)
+
+  def _compact(self):
+    """
+    Merges our journal into our sorted store.
+    """
+
+    log.debug("Merging %i fingerprints into our store of %i" % (len(self._journal), len(self._digests())))
+    tmp_path = self._path + '.tmp'
+
+    with open(tmp_path, 'wb') as tmp_file:
+      for digest in heapq.merge(iter(self._digests()), sorted(self._journal)):
+        tmp_file.write(digest)
+
+    self.close()
+    os.rename(tmp_path, self._path)
+    os.remove(self._journal_path)
+    self._journal = set()
+    self._open()
+
+  def _digests(self):
+    return _MappedDigests(self._mmap)
+
+  def __contains__(self, fingerprint):
+    digest = binascii.unhexlify(fingerprint)
+
+    if digest in self._journal:
+      return True
+
+    digests = self._digests()
+    i = bisect.bisect_left(digests, digest)
+    return i < len(digests) and digests[i] == digest
+
+  def __len__(self):
+    return len(self._digests()) + len(self._journal)
+
+
+class FirstSeenIndex(object):
+  """
+  When we first saw each relay within our longest window. Entries are kept
+  in the order we saw them, so expiring old ones and finding recent additions
+  just involves the ends of our queue rather than our whole history.
+
+  :var float last_run: unix timestamp when we last ran, **None** if never
+  :var dict last_notified: mapping of window hours to the unix timestamp
+    when we last notified for it
+  """
+
+  def __init__(self, path):
+    self._path = path
+    self._entries = collections.deque()  # (fingerprint, timestamp) tuples
+
+    self.last_run = None
+    self.last_notified = {}
+
+    if os.path.exists(path):
+      with open(path) as index_file:
+        for line in index_file:
+          entry = line.split()
+
+          if entry[0] == 'last_run':
+            self.last_run = float(entry[1])
+          elif entry[0] == 'notified':
+            self.last_notified[int(entry[1])] = float(entry[2])
+          elif entry[0] == 'first_seen':
+            self._entries.append((entry[1], float(entry[2])))
+
+  def add(self, fingerprint, timestamp):
+    """
+    Records when we first saw a relay.
+
+    :param str fingerprint: relay fingerprint
+    :param float timestamp: unix timestamp when we saw it
+    """
+
+    self._entries.append((fingerprint, timestamp))
+
+  def expire(self, timestamp):
+    """
+    Drops relays we first saw before the given time.
+
+    :param float timestamp: unix timestamp before which we drop entries
+    """
+
+    while self._entries and self._entries[0][1] < timestamp:
+      self._entries.popleft()
+
+  def seen_since(self, timestamp):
+    """
+    Provides relays we first saw after the given time.
+
+    :param float timestamp: unix timestamp to provide relays since
+
+    :returns: **list** of fingerprints
+    """
+
+    fingerprints = []
+
+    for fingerprint, first_seen in reversed(self._entries):
+      if first_seen < timestamp:
+        break
+
+      fingerprints.append(fingerprint)
+
+    return fingerprints
+
+  def save(self):
+    lines = []
+
+    if self.last_run is not None:
+      lines.append('last_run %i' % self.last_run)
+
+    for hours, timestamp in sorted(self.last_notified.items()):
+      lines.append('notified %i %i' % (hours, timestamp))
+
+    for fingerprint, timestamp in self._entries:
+      lines.append('first_seen %s %i' % (fingerprint, timestamp))
+
+    tmp_path = self._path + '.tmp'
+
+    with open(tmp_path, 'w') as index_file:
+      index_file.write('\n'.join(lines) + '\n')
+
+    os.rename(tmp_path, self._path)
+
+
+class _MappedDigests(object):
+  """
+  Sequence view of the digests within a memory-mapped store.
+  """
+
+  def __init__(self, mapped):
+    self._mapped = mapped
+
+  def __getitem__(self, i):
+    if i < 0 or i >= len(self):
+      raise IndexError(i)
+
+    return self._mapped[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]
+
+  def __len__(self):
+    return len(self._mapped) // DIGEST_SIZE if self._mapped else 0
+
+
 def main():
   prior_fingerprints = load_fingerprints()
-  downloader = DescriptorDownloader(timeout = 60, validate = True)
 
-  dry_run = False
+  # our store holds an open mmap, so close it however we exit
 
-  if not prior_fingerprints:
-    log.debug("We don't have any existing fingerprints so this will be a dry-run. No notifications will be sent.")
-    dry_run = True
-  else:
-    last_modified = os.stat(FINGERPRINTS_FILE).st_mtime  # unix timestamp for when it was last modified
-    seconds_ago = int(time.time() - last_modified)
+  try:
+    first_seen = FirstSeenIndex(FIRST_SEEN_FILE)
 
-    log.debug("Our fingerprint was last modified at %s (%i seconds ago)." % (time.ctime(last_modified), seconds_ago))
+    try:
+      # mapping of fingerprints to the relay's basic attributes
+      relays = dict((relay.fingerprint, relay) for relay in util.get_relays())
+    except (IOError, ValueError) as exc:
+      log.warn("Unable to retrieve the consensus: %s" % exc)
+      return
 
-    if seconds_ago > (3 * 60 * 60):
-      log.debug("Fingerprint file was last modified over three hours ago. No notifications will be sent for this run.")
-      dry_run = True
+    current_time = time.time()
 
-  query = downloader.get_consensus()
-  query.run(True)
+    new_fingerprints = [fp for fp in relays if fp not in prior_fingerprints]
+    log.debug("%i new relays found" % len(new_fingerprints))
 
-  if query.error:
-    log.warn("Unable to retrieve the consensus: %s" % query.error)
-    return
+    if len(prior_fingerprints):
+      for fingerprint in new_fingerprints:
+        first_seen.add(fingerprint, current_time)
 
-  # mapping of fingerprints to their router status entry
-  relays = dict((entry.fingerprint, entry) for entry in query)
+    first_seen.expire(current_time - max([hours for hours, _ in WINDOWS]) * 3600)
 
-  current_fingerprints = set(relays.keys())
-  new_fingerprints = current_fingerprints.difference(prior_fingerprints)
-  log.debug("%i new relays found" % len(new_fingerprints))
+    # Prior versions lacked our index, in which case our store's modification
+    # time is when we last ran.
 
-  if not dry_run and len(new_fingerprints) >= 50:
-    log.debug("Sending a notification...")
-    send_email([relays[fp] for fp in new_fingerprints])
+    last_run = first_seen.last_run if first_seen.last_run is not None else prior_fingerprints.last_modified()
 
-  save_fingerprints(prior_fingerprints.union(current_fingerprints))
+    if not len(prior_fingerprints) or last_run is None:
+      log.debug("We don't have any existing fingerprints so this will be a dry-run. No notifications will be sent.")
+    else:
+      log.debug("We last ran at %s (%i seconds ago)." % (time.ctime(last_run), current_time - last_run))
+      alerts = []  # (hours, new relays) tuples for windows we should notify for
 
+      for hours, threshold in WINDOWS:
+        # If we missed runs then relays that joined in the interim all seem
+        # new, so skip windows shorter than our gap (with a half hour grace).
 
-def send_email(new_relays):
-  # Constructs a mapping of nicknames to router status entries so we can
-  # provide a listing that's sorted by nicknames.
+        if current_time - last_run > (hours + 0.5) * 3600:
+          log.debug("Skipping the %i hour window since we last ran over %i hours ago." % (hours, hours))
+          continue
 
+        # We run hourly, but not at exact intervals, so windows span the runs
+        # within them (again with a half hour grace). Otherwise a run slightly
+        # over an hour ago would count twice in the one hour window.
+
+        window = (hours - 0.5) * 3600
+
+        recent_relays = [relays[fp] for fp in first_seen.seen_since(current_time - window) if fp in relays]
+        log.debug("%i new relays within the last %i hours" % (len(recent_relays), hours))
+
+        # Notify at most once per window so long ones don't email every hour.
+        # The one hour window spans a single run, so this never suppresses it.
+
+        if len(recent_relays) >= threshold and current_time - first_seen.last_notified.get(hours, 0) >= window:
+          alerts.append((hours, recent_relays))
+
+      if alerts:
+        log.debug("Sending a notification...")
+        send_email(alerts)
+
+        for hours, _ in alerts:
+          first_seen.last_notified[hours] = current_time
+
+    first_seen.last_run = current_time
+
+    try:
+      first_seen.save()
+    except Exception as exc:
+      log.debug("Unable to save our first seen index to '%s': %s" % (FIRST_SEEN_FILE, exc))
+
+    save_fingerprints(prior_fingerprints, relays.keys())
+  finally:
+    prior_fingerprints.close()
+
+
+def send_email(alerts):
+  # Summarizes each window we're notifying for, then lists the relays of the
+  # longest (which includes those of the shorter windows).
+  #
+  # Constructs a mapping of nicknames to relays so we can provide a listing
+  # that's sorted by nicknames. Our Relay tuples lack versions and exit
+  # policies, so only now do we parse the full router status entries.
+
+  summary = ''.join([EMAIL_SUMMARY % ('hour' if hours == 1 else '%i hours' % hours, len(relays)) for hours, relays in alerts])
+  new_relays = alerts[-1][1]
   nickname_to_relays = {}
 
   for entry in new_relays:
     nickname_to_relays.setdefault(entry.nickname, []).append(entry)
 
+  try:
+    router_status_entries = dict((entry.fingerprint, entry) for entry in util.get_consensus())
+  except (IOError, ValueError) as exc:
+    log.warn("Unable to parse the consensus: %s" % exc)
+    router_status_entries = {}
+
   relay_entries = []
 
   for nickname in sorted(nickname_to_relays.keys()):
     for relay in nickname_to_relays[nickname]:
-      relay_entries.append(RELAY_ENTRY % (relay.nickname, relay.fingerprint, relay.address, relay.or_port, relay.version, relay.exit_policy))
+      entry = router_status_entries.get(relay.fingerprint)
+      version, exit_policy = (entry.version, entry.exit_policy) if entry else ('unknown', 'unknown')
+      relay_entries.append(RELAY_ENTRY % (relay.nickname, relay.fingerprint, relay.address, relay.or_port, version, exit_policy))
 
   try:
-    body = EMAIL_BODY % len(new_relays)
+    body = EMAIL_BODY % summary
     body += "\n".join(relay_entries)
 
     util.send(EMAIL_SUBJECT, body = body)
@@ -99,45 +382,51 @@ def send_email(new_relays):
 
 
 def load_fingerprints():
+  """
+  Provides the store of fingerprints we've seen, converting the text file of
+  prior versions if we don't yet have one.
+
+  :returns: :class:`~sybil_checker.FingerprintStore` with prior fingerprints
+  """
+
   log.debug("Loading fingerprints...")
+  data_dir = util.get_path('data')
 
-  if not os.path.exists(FINGERPRINTS_FILE):
-    log.debug("  '%s' doesn't exist" % FINGERPRINTS_FILE)
-    return set()
+  if not os.path.exists(data_dir):
+    os.mkdir(data_dir)
 
-  try:
-    with open(FINGERPRINTS_FILE) as fingerprint_file:
-      fingerprints = fingerprint_file.read().strip()
+  store = FingerprintStore(FINGERPRINTS_FILE)
 
-      if not fingerprints:
-        log.debug("  '%s' is empty" % FINGERPRINTS_FILE)
-        return set()
+  if not len(store) and os.path.exists(LEGACY_FINGERPRINTS_FILE):
+    log.debug("  converting '%s' to our binary store" % LEGACY_FINGERPRINTS_FILE)
 
-      fingerprints = fingerprints.splitlines()
+    try:
+      with open(LEGACY_FINGERPRINTS_FILE) as fingerprint_file:
+        store.merge(fingerprint_file.read().split())
 
-      log.debug("  %i fingerprints found" % len(fingerprints))
-      return set(fingerprints)
-  except Exception as exc:
-    log.debug("  unable to read '%s': %s" % (FINGERPRINTS_FILE, exc))
-    return set()
+      # retain the legacy file's modification time so our staleness check applies
 
+      last_modified = os.stat(LEGACY_FINGERPRINTS_FILE).st_mtime
+      os.utime(FINGERPRINTS_FILE, (last_modified, last_modified))
+    except Exception as exc:
+      log.debug("  unable to convert '%s': %s" % (LEGACY_FINGERPRINTS_FILE, exc))
 
-def save_fingerprints(fingerprints):
-  data_dir = util.get_path('data')
+  log.debug("  %i fingerprints found" % len(store))
+  return store
 
-  try:
-    if not os.path.exists(data_dir):
-      os.mkdir(data_dir)
 
-    with open(FINGERPRINTS_FILE, 'w') as fingerprint_file:
-      fingerprint_file.write('\n'.join(fingerprints))
+def save_fingerprints(store, fingerprints):
+  try:
+    store.merge(fingerprints)
   except Exception as exc:
     log.debug("Unable to save fingerprints to '%s': %s" % (FINGERPRINTS_FILE, exc))
+  finally:
+    store.close()
 
 
 if __name__ == '__main__':
   try:
-    main()
+    util.profile('sybil_checker', main)
   except:
     msg = "sybil_checker.py failed with:\n\n%s" % traceback.format_exc()
     log.error(msg)
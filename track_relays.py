@@ -6,13 +6,15 @@
 Notifies if specific relays reappear in the network.
 """
 
+import binascii
 import datetime
+import hashlib
 import os
+import pickle
+import socket
 import time
 import traceback
 
-import stem.descriptor.remote
-import stem.exit_policy
 import stem.util.conf
 
 import util
@@ -22,6 +24,10 @@ log = util.get_logger('track_relays')
 EMAIL_SUBJECT = 'Relays Returned'
 ONE_WEEK = 7 * 24 * 60 * 60
 
+TRACKED_RELAYS_PATH = util.get_path('data', 'tracked_relays.cfg')
+WATCHLIST_CACHE_PATH = util.get_path('data', 'tracked_relays.cache')
+WATCHLIST_CACHE_VERSION = 1  # incremented when our cache's format changes
+
 EMAIL_BODY = """\
 The following previously relays flagged as being malicious have returned to the
 network...
@@ -72,37 +78,300 @@ class TrackedRelay(object):
     return '%s (%s)' % (self.identifier, ', '.join(attr))
 
 
-def get_tracked_relays():
+class AddressTrie(object):
+  """
+  Binary prefix trie of IPv4 and IPv6 address ranges. Looking up an address
+  takes time proportional to its length in bits (32 or 128) rather than the
+  number of ranges we have.
+
+  Individual addresses are simply ranges with a full length prefix.
   """
-  Provides the relays we're tracking.
 
-  :returns: **list** of **TrackedRelay** we're tracking
+  def __init__(self, roots = None):
+    self._roots = roots if roots is not None else {4: {}, 6: {}}
+
+  def roots(self):
+    """
+    Provides our underlying structure, which consists solely of builtin
+    types so it can be serialized.
+
+    :returns: **dict** we can be constructed from
+    """
+
+    return self._roots
+
+  def add(self, address, value):
+    """
+    Associates a value with an address or range.
+
+    :param str address: address, or range such as '192.168.0.0/16' or
+      '2001:db8::/32'
+    :param object value: value to provide for addresses within this range
+
+    :raises: **ValueError** if the address is malformed
+    """
+
+    if '/' in address:
+      address, prefix = address.split('/', 1)
+
+      if not prefix.isdigit():
+        raise ValueError("'%s/%s' has a malformed prefix length" % (address, prefix))
+
+      prefix = int(prefix)
+    else:
+      prefix = None
+
+    version, bits = _address_bits(address)
+
+    if prefix is None:
+      prefix = len(bits)
+    elif prefix > len(bits):
+      raise ValueError("'%s/%i' has a prefix longer than its address" % (address, prefix))
+
+    node = self._roots[version]
+
+    for bit in bits[:prefix]:
+      node = node.setdefault(bit, {})
+
+    node.setdefault(None, []).append(value)
+
+  def get(self, address):
+    """
+    Provides the values of all ranges containing an address.
+
+    :param str address: address to look up
+
+    :returns: **list** of values for the ranges this address is within
+
+    :raises: **ValueError** if the address is malformed
+    """
+
+    version, bits = _address_bits(address)
+    node, results = self._roots[version], []
+
+    for bit in bits:
+      results += node.get(None, [])
+      node = node.get(bit)
+
+      if node is None:
+        return results
+
+    return results + node.get(None, [])
+
+
+def _address_bits(address):
+  """
+  Provides the binary representation of an address.
+
+  :returns: **tuple** of the form (ip_version, bit_str)
+
+  :raises: **ValueError** if the address is malformed
+  """
+
+  address = address.strip('[]')
+  family, version = (socket.AF_INET6, 6) if ':' in address else (socket.AF_INET, 4)
+
+  try:
+    packed = socket.inet_pton(family, address)
+  except (socket.error, UnicodeError):
+    raise ValueError("'%s' isn't a valid IPv%i address" % (address, version))
+
+  return version, bin(int(binascii.hexlify(packed), 16))[2:].zfill(len(packed) * 8)
+
+
+class Watchlist(object):
+  """
+  Lookup structures compiled from our tracked_relays.cfg. These are cached so
+  we only parse our config when it changes, or an entry expires.
+
+  :var float mtime: modification time of the config we were compiled from
+  :var str digest: sha256 digest of the config we were compiled from
+  :var dict relays: identifier => **TrackedRelay** for our config's entries,
+    including those that have expired
+  :var AddressTrie addresses: identifiers of unexpired entries by their
+    addresses and address ranges
+  :var dict fingerprints: identifiers of unexpired entries by fingerprint
+  :var datetime next_expiry: when our next entry expires, **None** if never
+  :var set expired: identifiers of expired entries we've notified about
+  """
+
+  def __init__(self, mtime, digest, relays, expired = None):
+    self.mtime = mtime
+    self.digest = digest
+    self.relays = dict([(relay.identifier, relay) for relay in relays])
+    self.addresses = AddressTrie()
+    self.fingerprints = {}
+    self.next_expiry = None
+    self.expired = set(expired) if expired else set()
+
+    now = datetime.datetime.now()
+
+    for relay in relays:
+      if relay.expires <= now:
+        continue
+
+      for address in relay.addresses:
+        self.addresses.add(address, relay.identifier)
+
+      for fingerprint in relay.fingerprints:
+        self.fingerprints[fingerprint] = relay.identifier
+
+      if self.next_expiry is None or relay.expires < self.next_expiry:
+        self.next_expiry = relay.expires
+
+  def newly_expired(self):
+    """
+    Provides entries that have expired, but we haven't yet notified about.
+
+    :returns: **list** of expired **TrackedRelay**
+    """
+
+    now = datetime.datetime.now()
+    return [relay for relay in self.relays.values() if relay.expires <= now and relay.identifier not in self.expired]
+
+  def is_expired(self):
+    """
+    Checks if any of our entries have expired since we were compiled.
+    """
+
+    return self.next_expiry is not None and self.next_expiry <= datetime.datetime.now()
+
+  def recompile(self):
+    """
+    Provides a watchlist without our expired entries.
+
+    :returns: **Watchlist** with the same config as ourselves
+    """
+
+    return Watchlist(self.mtime, self.digest, self.relays.values(), self.expired)
+
+  def to_cache(self):
+    """
+    Provides our content as builtin types, so our cache doesn't depend on the
+    module we're loaded from.
+
+    :returns: **dict** we can be restored from with
+      :func:`~track_relays.Watchlist.from_cache`
+    """
+
+    config = {}
+
+    for relay in self.relays.values():
+      config['%s.description' % relay.identifier] = relay.description
+      config['%s.expires' % relay.identifier] = relay.expires.strftime('%Y-%m-%d')
+      config['%s.address' % relay.identifier] = list(relay.addresses)
+      config['%s.fingerprint' % relay.identifier] = list(relay.fingerprints)
+
+    return {
+      'version': WATCHLIST_CACHE_VERSION,
+      'mtime': self.mtime,
+      'digest': self.digest,
+      'config': config,
+      'addresses': self.addresses.roots(),
+      'fingerprints': self.fingerprints,
+      'next_expiry': self.next_expiry,
+      'expired': sorted(self.expired),
+    }
+
+  @classmethod
+  def from_cache(cls, cache):
+    """
+    Restores a watchlist without recompiling its lookups.
+
+    :param dict cache: content from :func:`~track_relays.Watchlist.to_cache`
+
+    :returns: **Watchlist** with this content
+
+    :raises: **ValueError** if the cache isn't in a format we recognize
+    """
+
+    if not isinstance(cache, dict) or cache.get('version') != WATCHLIST_CACHE_VERSION:
+      raise ValueError('unrecognized watchlist cache format')
+
+    identifiers = set([key.split('.')[0] for key in cache['config']])
+
+    watchlist = cls(cache['mtime'], cache['digest'], [])
+    watchlist.relays = dict([(identifier, TrackedRelay(identifier, cache['config'])) for identifier in identifiers])
+    watchlist.addresses = AddressTrie(cache['addresses'])
+    watchlist.fingerprints = cache['fingerprints']
+    watchlist.next_expiry = cache['next_expiry']
+    watchlist.expired = set(cache['expired'])
+
+    return watchlist
+
+
+def get_watchlist():
+  """
+  Provides the compiled lookups for the relays we're tracking. This is read
+  from our cache unless our config has changed (by modification time, then
+  digest) or an entry has expired. We notify about each expired entry once.
+
+  :returns: **Watchlist** for the relays we're tracking
 
   :raises: **ValueError** if our config file is malformed
   """
 
-  config = stem.util.conf.get_config('tracked_relays')
-  config.load(util.get_path('data', 'tracked_relays.cfg'))
+  mtime = os.stat(TRACKED_RELAYS_PATH).st_mtime
+  watchlist, is_changed = None, False
 
-  results, expired = [], []
+  if os.path.exists(WATCHLIST_CACHE_PATH):
+    try:
+      with open(WATCHLIST_CACHE_PATH, 'rb') as cache_file:
+        watchlist = Watchlist.from_cache(pickle.load(cache_file))
+    except Exception as exc:
+      log.info("Unable to read '%s', treating it as a cache miss and recompiling our watchlist: %s" % (WATCHLIST_CACHE_PATH, exc))
 
-  for identifier in set([key.split('.')[0] for key in config.keys()]):
-    relay = TrackedRelay(identifier, config)
+  if not watchlist or watchlist.mtime != mtime:
+    with open(TRACKED_RELAYS_PATH, 'rb') as config_file:
+      digest = hashlib.sha256(config_file.read()).hexdigest()
 
-    if relay.expires > datetime.datetime.now():
-      results.append(relay)
+    if watchlist and watchlist.digest == digest:
+      watchlist.mtime = mtime
     else:
-      expired.append(relay)
+      log.debug("Compiling our watchlist from '%s'" % TRACKED_RELAYS_PATH)
+      watchlist = Watchlist(mtime, digest, get_tracked_relays(), watchlist.expired if watchlist else None)
+
+    is_changed = True
+
+  if watchlist.is_expired():
+    watchlist = watchlist.recompile()
+    is_changed = True
 
-  if expired:
+  newly_expired = watchlist.newly_expired()
+
+  if newly_expired:
     body = 'The following entries in tracked_relays.cfg have expired...\n\n'
 
-    for relay in expired:
+    for relay in newly_expired:
       body += '* %s (%s)\n' % (relay.identifier, relay.expires.strftime('%Y-%m-%d'))
+      watchlist.expired.add(relay.identifier)
 
     util.send('tracked_relays.cfg entries expired', body = body, to = ['gk@torproject.org'])
+    is_changed = True
+
+  if is_changed:
+    try:
+      with open(WATCHLIST_CACHE_PATH, 'wb') as cache_file:
+        pickle.dump(watchlist.to_cache(), cache_file, pickle.HIGHEST_PROTOCOL)
+    except IOError as exc:
+      log.debug("Unable to cache our watchlist to '%s': %s" % (WATCHLIST_CACHE_PATH, exc))
 
-  return results
+  return watchlist
+
+
+def get_tracked_relays():
+  """
+  Provides all entries of our config, including those that have expired.
+
+  :returns: **list** of **TrackedRelay** in our config
+
+  :raises: **ValueError** if our config file is malformed
+  """
+
+  config = stem.util.conf.get_config('tracked_relays')
+  config.load(TRACKED_RELAYS_PATH)
+
+  return [TrackedRelay(identifier, config) for identifier in set([key.split('.')[0] for key in config.keys()])]
 
 
 def main():
@@ -114,37 +383,31 @@ def main():
   else:
     last_notified_config._path = last_notified_path
 
-  # Map addresses and fingerprints to relays for constant time lookups. Address
-  # ranges are handled separately cuz... well, they're a pita.
+  # Fingerprints map to relays for constant time lookups, and addresses (both
+  # individual and ranges) to a trie so lookups scale with address length
+  # rather than the number of entries we track.
 
-  tracked_addresses = {}
-  tracked_address_ranges = {}
-  tracked_fingerprints = {}
+  watchlist = get_watchlist()
 
-  for relay in get_tracked_relays():
-    for address in relay.addresses:
-      if '/' in address:
-        # It's a total hack, but taking advantage of exit policies where we
-        # already support address ranges.
+  try:
+    consensus = util.get_relays()
+  except (IOError, ValueError) as exc:
+    log.warn("Unable to retrieve the consensus: %s" % exc)
+    return
 
-        tracked_address_ranges[stem.exit_policy.ExitPolicyRule('accept %s:*' % address)] = relay
-      else:
-        tracked_addresses[address] = relay
+  found_relays = {}  # mapping of TrackedRelay => util.Relay
 
-    for fingerprint in relay.fingerprints:
-      tracked_fingerprints[fingerprint] = relay
+  for desc in consensus:
+    matches = watchlist.addresses.get(desc.address)
 
-  found_relays = {}  # mapping of TrackedRelay => RouterStatusEntry
+    for address, _, _ in desc.or_addresses:
+      matches += watchlist.addresses.get(address)
 
-  for desc in stem.descriptor.remote.get_consensus():
-    if desc.address in tracked_addresses:
-      found_relays.setdefault(tracked_addresses[desc.address], []).append(desc)
-    elif desc.fingerprint in tracked_fingerprints:
-      found_relays.setdefault(tracked_fingerprints[desc.fingerprint], []).append(desc)
-    else:
-      for addr_entry, relay in tracked_address_ranges.items():
-        if addr_entry.is_match(desc.address):
-          found_relays.setdefault(relay, []).append(desc)
+    if desc.fingerprint in watchlist.fingerprints:
+      matches.append(watchlist.fingerprints[desc.fingerprint])
+
+    for identifier in set(matches):
+      found_relays.setdefault(watchlist.relays[identifier], []).append(desc)
 
   all_descriptors = []
 
@@ -193,7 +456,7 @@ def is_notification_suppressed(relays):
 
 if __name__ == '__main__':
   try:
-    main()
+    util.profile('track_relays', main)
   except:
     msg = "track_relays.py failed with:\n\n%s" % traceback.format_exc()
     log.error(msg)
@@ -2,23 +2,63 @@
 Module for issuing email notifications to me via gmail.
 """
 
+import base64
+import binascii
+import calendar
+import collections
+import copy
+import cProfile
+import datetime
+import email.utils
+import errno
 import getpass
+import io
 import logging
 import os
+import random
+import re
+import select
 import socket
 import smtplib
+import time
+import zlib
 
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
+try:
+  import tracemalloc  # added in python 3.4
+except ImportError:
+  tracemalloc = None
+
+import stem.descriptor
+import stem.descriptor.remote
+import stem.directory
 import stem.util.connection
 import stem.util.log
 
+try:
+  import urllib.request as urllib  # python 3
+except ImportError:
+  import urllib2 as urllib  # python 2
+
+Probe = collections.namedtuple('Probe', ('address', 'port', 'error', 'latency'))
+Relay = collections.namedtuple('Relay', ('fingerprint', 'nickname', 'digest', 'address', 'or_port', 'published', 'or_addresses'))
+
 FROM_ADDRESS = 'gk@torproject.org'
 TO_ADDRESSES = ['tor-consensus-health@lists.torproject.org']
 ERROR_ADDRESS = 'gk@torproject.org'
 
 TEST_RUN = getpass.getuser() != 'doctor'  # print script results rather than emailing
+PROFILE = bool(os.environ.get('DOCTOR_PROFILE'))  # write profiling results to our logs
+PROFILE_TOP_ALLOCATIONS = 25
+PROBE_TIMEOUT = 10  # seconds we'll wait to connect to an endpoint
+PROBE_CONCURRENCY = 256  # maximum connections we'll attempt at once
+DIRECTORY_OVERRIDE = os.environ.get('DOCTOR_DIRECTORY_OVERRIDE')  # 'address:port' of a local_directory.py server
+
+CONSENSUS_RESOURCE = '/tor/status-vote/current/consensus.z'
+CONSENSUS_TYPE = 'network-status-consensus-3 1.0'
+CONSENSUS_DOWNLOAD_ATTEMPTS = 3
 
 
 def get_path(*comp):
@@ -58,30 +98,561 @@ def get_logger(name):
   return log
 
 
+def profile(name, function, *args, **kwargs):
+  """
+  Runs the given function. If the DOCTOR_PROFILE environment variable is set
+  this is profiled, writing the following to our 'logs' directory...
+
+    * **<name>.pstats** with cProfile results (view with 'python -m pstats')
+    * **<name>.allocations** with the largest memory allocations made while
+      the function ran (python 3.4+ only)
+
+  Memory is traced for the whole process, so functions we profile
+  concurrently will include each other's allocations.
+
+  :param str name: name of our profiling results
+  :param function function: function to be run
+  :param list args: positional arguments for the function
+  :param dict kwargs: keyword arguments for the function
+
+  :returns: result of the function
+  """
+
+  if not PROFILE:
+    return function(*args, **kwargs)
+
+  log_dir = get_path('logs')
+
+  if not os.path.exists(log_dir):
+    os.makedirs(log_dir)
+
+  profiler = cProfile.Profile()
+
+  try:
+    profiler.enable()
+  except ValueError:
+    profiler = None  # python 3.12+ only allows one active profiler at a time
+
+  if tracemalloc and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+  snapshot = tracemalloc.take_snapshot() if tracemalloc else None
+
+  try:
+    return function(*args, **kwargs)
+  finally:
+    if profiler:
+      profiler.disable()
+      profiler.dump_stats(os.path.join(log_dir, name + '.pstats'))
+
+    if snapshot:
+      current, peak = tracemalloc.get_traced_memory()
+      allocations = tracemalloc.take_snapshot().compare_to(snapshot, 'lineno')[:PROFILE_TOP_ALLOCATIONS]
+
+      with open(os.path.join(log_dir, name + '.allocations'), 'w') as allocations_file:
+        allocations_file.write('current: %0.1f MB, peak: %0.1f MB\n\n' % (current / 1048576.0, peak / 1048576.0))
+
+        for stat in allocations:
+          allocations_file.write('%s\n' % stat)
+
+
 def is_reachable(address, port):
   return check_reachability(address, port) == None
 
 
-def check_reachability(address, port):
+def check_reachability(address, port, timeout = PROBE_TIMEOUT):
   """
   Simple check to see if we can establish a connection to the given endpoint.
 
   :param str address: IPv4 or IPv6 address to check
   :param int port: port to check
+  :param float timeout: seconds to wait for the connection
 
   :returns: **None** if the endpoint is reachable and a **str** describing the issue otherwise
   """
 
-  socket_type = socket.AF_INET6 if stem.util.connection.is_valid_ipv6_address(address) else socket.AF_INET
-  test_socket = socket.socket(socket_type, socket.SOCK_STREAM)
+  return probe_reachability([(address, port)], timeout)[0].error
+
+
+def probe_reachability(endpoints, timeout = PROBE_TIMEOUT, concurrency = PROBE_CONCURRENCY):
+  """
+  Checks if we can establish connections to several endpoints. Connections are
+  made concurrently, so this takes roughly a single timeout rather than one
+  for each endpoint.
+
+  :param list endpoints: (address, port) tuples to check
+  :param float timeout: seconds to wait for each connection
+  :param int concurrency: maximum number of connections to attempt at once
+
+  :returns: **list** of **Probe** results in the same order as our endpoints,
+    these have a **str** error if the endpoint is unreachable (**None**
+    otherwise) and the seconds our connection took (**None** if it timed out)
+  """
+
+  results = []
+
+  for i in range(0, len(endpoints), concurrency):
+    results += _probe_reachability(endpoints[i:i + concurrency], timeout)
+
+  return results
+
+
+def _probe_reachability(endpoints, timeout):
+  results = [None] * len(endpoints)
+  pending = {}  # socket => (index, start time)
+
+  for i, (address, port) in enumerate(endpoints):
+    socket_type = socket.AF_INET6 if stem.util.connection.is_valid_ipv6_address(address) else socket.AF_INET
+    test_socket = socket.socket(socket_type, socket.SOCK_STREAM)
+    test_socket.setblocking(0)
+    start_time = time.time()
+
+    try:
+      status = test_socket.connect_ex((address, port))
+    except Exception as exc:
+      results[i] = Probe(address, port, str(exc), None)
+      test_socket.close()
+      continue
+
+    if status in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+      pending[test_socket] = (i, start_time)
+    else:
+      results[i] = Probe(address, port, _socket_error(status), time.time() - start_time)
+      test_socket.close()
+
+  deadline = time.time() + timeout
+
+  while pending and time.time() < deadline:
+    _, writable, errored = select.select([], list(pending), list(pending), deadline - time.time())
+
+    for test_socket in set(writable + errored):
+      i, start_time = pending.pop(test_socket)
+      address, port = endpoints[i]
+      status = test_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+      results[i] = Probe(address, port, _socket_error(status), time.time() - start_time)
+      test_socket.close()
+
+  for test_socket, (i, start_time) in pending.items():
+    address, port = endpoints[i]
+    results[i] = Probe(address, port, 'timed out', None)
+    test_socket.close()
+
+  return results
+
+
+def _socket_error(status):
+  """
+  Describes the errno from a connection attempt, matching the str of the
+  socket.error we'd get from a blocking connect.
+  """
+
+  return '[Errno %i] %s' % (status, os.strerror(status)) if status else None
+
+
+def get_authorities():
+  """
+  Provides tor's directory authorities. If the DOCTOR_DIRECTORY_OVERRIDE
+  environment variable is set these instead point to a local_directory.py
+  server, with each authority (sorted by nickname) on successive ports.
+
+  :returns: **dict** of authority nicknames to their
+    :class:`~stem.directory.Authority`
+  """
+
+  authorities = stem.directory.Authority.from_cache()
+
+  if DIRECTORY_OVERRIDE:
+    address, port = DIRECTORY_OVERRIDE.rsplit(':', 1)
+
+    for i, nickname in enumerate(sorted(authorities)):
+      authorities[nickname] = copy.copy(authorities[nickname])  # don't alter stem's copy
+      authorities[nickname].address = address
+      authorities[nickname].dir_port = int(port) + i
+
+  return authorities
+
+
+def get_fallbacks():
+  """
+  Provides tor's fallback directories. If the DOCTOR_DIRECTORY_OVERRIDE
+  environment variable is set these are from stem's cache, and all point to
+  the local_directory.py port following those of the authorities.
+
+  :returns: **dict** of fingerprints to their
+    :class:`~stem.directory.Fallback`
+
+  :raises: **IOError** if unable to retrieve the fallback directories
+  """
+
+  if not DIRECTORY_OVERRIDE:
+    return stem.directory.Fallback.from_remote()
+
+  address, port = DIRECTORY_OVERRIDE.rsplit(':', 1)
+  port = int(port) + len(stem.directory.Authority.from_cache())
+  fallbacks = stem.directory.Fallback.from_cache()
+
+  for fingerprint, fallback in fallbacks.items():
+    fallbacks[fingerprint] = copy.copy(fallback)
+    fallbacks[fingerprint].address = address
+    fallbacks[fingerprint].or_port = port
+    fallbacks[fingerprint].dir_port = port
+    fallbacks[fingerprint].orport_v6 = None
+
+  return fallbacks
+
+
+def get_consensus(validate = False, document_handler = stem.descriptor.DocumentHandler.ENTRIES, timeout = 60):
+  """
+  Provides the present consensus. Our scripts all run hourly against the same
+  consensus, so this keeps its compressed content in an on-disk cache keyed by
+  its valid-after time. We only contact an authority once our cached copy is
+  no longer fresh, and even then with an If-Modified-Since header so we just
+  download it if there's something newer.
+
+  :param bool validate: checks the validity of the consensus if **True**
+  :param stem.descriptor.__init__.DocumentHandler document_handler: method in
+    which to provide the consensus
+  :param int timeout: seconds to wait on each authority we try
+
+  :returns: **list** with the consensus' router status entries, or the
+    document itself if our document_handler is DOCUMENT
+
+  :raises:
+    * **IOError** if we don't have a valid consensus and are unable to
+      download one
+    * **ValueError** if the consensus is malformed
+  """
+
+  try:
+    content = zlib.decompress(_get_consensus_content(timeout))
+  except zlib.error as exc:
+    raise ValueError('Consensus is not zlib compressed: %s' % exc)
+
+  return list(stem.descriptor.parse_file(
+    io.BytesIO(content),
+    CONSENSUS_TYPE,
+    validate = validate,
+    document_handler = document_handler,
+  ))
+
+
+def get_relays(timeout = 60):
+  """
+  Provides the basic attributes of relays in the present consensus. This is
+  far cheaper than :func:`~util.get_consensus` since we read just the 'r'
+  and 'a' lines of each router status entry as we decompress, rather than
+  parse full stem descriptors.
+
+  Like stem, a relay's **digest** is the hex sha1 of its server descriptor,
+  and its **or_addresses** are a list of (address, port, is_ipv6) tuples for
+  its additional ORPorts.
+
+  :param int timeout: seconds to wait on each authority we try
+
+  :returns: **list** of **Relay** tuples
+
+  :raises:
+    * **IOError** if we don't have a valid consensus and are unable to
+      download one
+    * **ValueError** if the consensus is malformed
+  """
+
+  # read eagerly so malformed content raises here rather than while our
+  # caller iterates
+
+  return list(_iter_relays(_get_consensus_content(timeout)))
+
+
+def _iter_relays(content):
+  relay = None
+
+  for line in _iter_lines(content):
+    if line.startswith(b'r '):
+      if relay:
+        yield relay
+
+      relay = _parse_r_line(line)
+    elif line.startswith(b'a ') and relay:
+      relay.or_addresses.append(_parse_a_line(line))
+
+  if relay:
+    yield relay
+
+
+def _iter_lines(content):
+  decompressor = zlib.decompressobj()
+  remainder = b''
 
   try:
-    test_socket.connect((address, port))
+    for i in range(0, len(content), 65536):
+      lines = (remainder + decompressor.decompress(content[i:i + 65536])).split(b'\n')
+      remainder = lines.pop()
+
+      for line in lines:
+        yield line
+
+    yield remainder + decompressor.flush()
+  except zlib.error as exc:
+    raise ValueError('Consensus is not zlib compressed: %s' % exc)
+
+
+def _parse_r_line(line):
+  """
+  Parses a router status entry's line of the form...
+
+    r nickname identity digest publication_date publication_time address or_port dir_port
+
+  :param bytes line: line to be parsed
+
+  :returns: **Relay** for the line
+
+  :raises: **ValueError** if the line is malformed
+  """
+
+  entry = line.decode('utf-8').split()
+
+  if len(entry[1:]) != 8:
+    raise ValueError("Router status entry's 'r' line should have eight values: %s" % line)
+
+  try:
+    fingerprint = binascii.hexlify(base64.b64decode(entry[2] + '=')).decode('utf-8').upper()
+  except (TypeError, binascii.Error):
+    raise ValueError("Router status entry's identity isn't base64: %s" % line)
+
+  try:
+    digest = binascii.hexlify(base64.b64decode(entry[3] + '=')).decode('utf-8').upper()
+  except (TypeError, binascii.Error):
+    raise ValueError("Router status entry's digest isn't base64: %s" % line)
+
+  published = datetime.datetime.strptime('%s %s' % (entry[4], entry[5]), '%Y-%m-%d %H:%M:%S')
+
+  return Relay(fingerprint, entry[1], digest, entry[6], int(entry[7]), published, [])
+
+
+def _parse_a_line(line):
+  """
+  Parses a router status entry's line of the form...
+
+    a address:port
+
+  IPv6 addresses are bracketed, for instance '[2001:db8::1]:9001'.
+
+  :param bytes line: line to be parsed
+
+  :returns: **tuple** of the form (address, port, is_ipv6)
+
+  :raises: **ValueError** if the line is malformed
+  """
+
+  entry = line.decode('utf-8')[2:].strip()
+
+  if ':' not in entry:
+    raise ValueError("Router status entry's 'a' line should be an 'address:port': %s" % line)
+
+  address, port = entry.rsplit(':', 1)
+  is_ipv6 = address.startswith('[') and address.endswith(']')
+
+  if not port.isdigit():
+    raise ValueError("Router status entry's 'a' line has a malformed port: %s" % line)
+
+  return (address[1:-1] if is_ipv6 else address, int(port), is_ipv6)
+
+
+def _get_consensus_content(timeout):
+  """
+  Provides the compressed content of the present consensus, from our cache if
+  it's still fresh.
+  """
+
+  content, (valid_after, fresh_until, valid_until) = _read_cached_consensus()
+
+  if not content or datetime.datetime.utcnow() >= fresh_until:
+    try:
+      new_content = _download_consensus(valid_after, timeout)
+
+      if new_content:
+        _store_consensus(new_content)
+        content = new_content
+    except IOError:
+      if not content or datetime.datetime.utcnow() >= valid_until:
+        raise
+
+  return content
+
+
+def cache_consensus(content):
+  """
+  Adds a consensus we've downloaded by other means to the cache used by
+  :func:`~util.get_consensus`. This is a no-op if it isn't newer than what we
+  already have.
+
+  :param bytes content: uncompressed consensus content
+
+  :raises: **IOError** if unable to write to the cache
+  """
+
+  valid_after = _consensus_times(content)[0]
+  cached_content, (cached_valid_after, _, _) = _read_cached_consensus()
+
+  if cached_content and valid_after <= cached_valid_after:
+    return
+
+  _store_consensus(zlib.compress(content))
+
+
+def _read_cached_consensus():
+  """
+  Provides our cached consensus. If it's unreadable or corrupt then it's
+  removed so we download a replacement.
+
+  :returns: **tuple** of the form (content, (valid_after, fresh_until,
+    valid_until)), with **None** values if we lack a usable consensus
+  """
+
+  cache_path = _cached_consensus_path()
+
+  if not cache_path:
+    return None, (None, None, None)
+
+  try:
+    with open(cache_path, 'rb') as cache_file:
+      content = cache_file.read()
+
+    return content, _consensus_times(_decompress_header(content))
+  except (IOError, ValueError):
+    try:
+      os.remove(cache_path)
+    except OSError:
+      pass  # another script might've already removed it
+
+    return None, (None, None, None)
+
+
+def _cached_consensus_path():
+  """
+  Provides the path of our newest cached consensus.
+
+  :returns: **str** path of our cached consensus, **None** if we have none
+  """
+
+  cache_dir = get_path('data', 'consensus_cache')
+
+  if not os.path.exists(cache_dir):
     return None
-  except Exception as exc:
-    return str(exc)
-  finally:
-    test_socket.close()
+
+  cached = sorted([filename for filename in os.listdir(cache_dir) if filename.endswith('-consensus.z')])
+  return os.path.join(cache_dir, cached[-1]) if cached else None
+
+
+def _store_consensus(content):
+  """
+  Persists a compressed consensus, replacing anything we had cached.
+
+  :param bytes content: zlib compressed consensus content
+  """
+
+  cache_dir = get_path('data', 'consensus_cache')
+  valid_after = _consensus_times(_decompress_header(content))[0]
+
+  if not os.path.exists(cache_dir):
+    os.makedirs(cache_dir)
+
+  # Scripts run concurrently from cron, so write to a temporary file and
+  # rename it so readers never see a partial consensus.
+
+  path = os.path.join(cache_dir, valid_after.strftime('%Y-%m-%d-%H-%M-%S-consensus.z'))
+  tmp_path = '%s.%i.tmp' % (path, os.getpid())
+
+  with open(tmp_path, 'wb') as cache_file:
+    cache_file.write(content)
+
+  os.rename(tmp_path, path)
+
+  for filename in os.listdir(cache_dir):
+    if filename.endswith('-consensus.z') and filename < os.path.basename(path):
+      os.remove(os.path.join(cache_dir, filename))
+
+
+def _consensus_times(content):
+  """
+  Reads the timestamps from a consensus' header.
+
+  :param bytes content: start of an uncompressed consensus
+
+  :returns: tuple of the form (valid_after, fresh_until, valid_until)
+
+  :raises: **ValueError** if the header lacks these fields
+  """
+
+  times = []
+
+  for keyword in ('valid-after', 'fresh-until', 'valid-until'):
+    match = re.search(b'^' + keyword.encode('utf-8') + b' (.+)$', content, re.MULTILINE)
+
+    if not match:
+      raise ValueError("Consensus lacks a '%s' line" % keyword)
+
+    times.append(datetime.datetime.strptime(match.group(1).decode('utf-8').strip(), '%Y-%m-%d %H:%M:%S'))
+
+  return tuple(times)
+
+
+def _decompress_header(content):
+  """
+  Decompresses just enough of a compressed consensus to read its header.
+
+  :param bytes content: zlib compressed consensus content
+
+  :returns: **bytes** with the start of the uncompressed consensus
+
+  :raises: **ValueError** if the content isn't zlib compressed
+  """
+
+  try:
+    return zlib.decompressobj().decompress(content, 8192)
+  except zlib.error as exc:
+    raise ValueError('Consensus is not zlib compressed: %s' % exc)
+
+
+def _download_consensus(if_modified_since, timeout):
+  """
+  Downloads the compressed consensus from a random directory authority,
+  trying others if it fails.
+
+  :param datetime if_modified_since: valid-after of the consensus we have
+  :param int timeout: seconds to wait on each authority
+
+  :returns: **bytes** with the compressed consensus, or **None** if it hasn't
+    changed since if_modified_since
+
+  :raises: **IOError** if unable to download the consensus
+  """
+
+  authorities = [auth for auth in get_authorities().values() if auth.nickname not in stem.descriptor.remote.DIR_PORT_BLACKLIST]
+  headers = {'User-Agent': stem.USER_AGENT}
+
+  if if_modified_since:
+    headers['If-Modified-Since'] = email.utils.formatdate(calendar.timegm(if_modified_since.utctimetuple()), usegmt = True)
+
+  errors = []
+
+  for authority in random.sample(authorities, min(CONSENSUS_DOWNLOAD_ATTEMPTS, len(authorities))):
+    url = 'http://%s:%i%s' % (authority.address, authority.dir_port, CONSENSUS_RESOURCE)
+
+    try:
+      content = urllib.urlopen(urllib.Request(url, headers = headers), timeout = timeout).read()
+      _consensus_times(_decompress_header(content))  # check that it's a consensus before we cache it
+      return content
+    except urllib.HTTPError as exc:
+      if exc.code == 304:
+        return None
+
+      errors.append('%s (%s)' % (url, exc))
+    except Exception as exc:
+      errors.append('%s (%s)' % (url, exc))
+
+  raise IOError('Unable to download the consensus: %s' % ', '.join(errors))
 
 
 def log_stem_debugging(name):